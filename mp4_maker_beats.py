@@ -0,0 +1,223 @@
+import os
+import numpy as np
+import mp4_maker_workspace
+from mp4_maker_loudness import get_file_content_hash
+from mp4_maker_ffmpeg_runner import iter_ffmpeg_output, FFmpegRunError
+
+# ===BEAT OPTIONS===
+BEAT_SAMPLE_RATE = 11025  # Onsets live well below 5kHz, decoding at a quarter of CD rate keeps the analysis cheap
+BEAT_FRAME_LENGTH = 1024  # Samples per FFT frame
+BEAT_HOP_LENGTH = 256  # Samples between frames, about 23ms at BEAT_SAMPLE_RATE
+BEAT_CHUNK_SECONDS = 30  # Audio decoded and analyzed at a time, bounds memory for tracks of any length
+BEAT_MIN_BPM = 60
+BEAT_MAX_BPM = 200
+BEAT_PREFERRED_BPM = 120  # Tempo estimates are biased towards this to avoid half/double tempo picks
+BEAT_CACHE_FILE = os.path.join(os.getenv('MP4_MAKER_AUDIO_DIR', 'audios'), 'beat_cache.json')  # Beat grids, keyed by content hash
+BEAT_SNAP_WINDOW = 0.5  # A cut moves to a beat at most this fraction of display_duration_per_image away
+BEAT_MIN_IMAGE_DURATION = 0.5  # No image is shown for less than this fraction of display_duration_per_image
+# ===BEAT OPTIONS===
+
+
+def iter_pcm_chunks(filename, sample_rate=BEAT_SAMPLE_RATE, chunk_seconds=BEAT_CHUNK_SECONDS):
+    # Mono float32 PCM straight from ffmpeg's stdout, never the whole track in memory
+    chunk_size = int(sample_rate * chunk_seconds) * 4
+    command = ["ffmpeg", "-i", filename, "-vn", "-ac", "1", "-ar", str(sample_rate), "-f", "f32le", "pipe:1"]
+    leftover = b''
+    for data in iter_ffmpeg_output(command, chunk_size):
+        data = leftover + data
+        usable = len(data) - len(data) % 4
+        leftover = data[usable:]
+        yield np.frombuffer(data[:usable], dtype='<f4')
+
+
+def compute_onset_envelope(pcm_chunks, frame_length=BEAT_FRAME_LENGTH, hop_length=BEAT_HOP_LENGTH):
+    """
+    Spectral flux onset strength, one value per hop.
+
+    :param pcm_chunks: Iterable of mono float32 sample arrays, in order.
+    :return: 1-D array with the onset strength of every frame.
+    """
+    window = np.hanning(frame_length).astype(np.float32)
+    carry = np.zeros(0, dtype=np.float32)
+    previous_spectrum = None
+    envelope = []
+
+    for chunk in pcm_chunks:
+        samples = np.concatenate((carry, chunk))
+        if len(samples) < frame_length:
+            carry = samples
+            continue
+
+        frames = np.lib.stride_tricks.sliding_window_view(samples, frame_length)[::hop_length]
+        # Samples not fully consumed by this chunk's frames start the next one
+        carry = samples[len(frames) * hop_length:]
+
+        spectrum = np.log1p(100.0 * np.abs(np.fft.rfft(frames * window, axis=1)))
+        if previous_spectrum is None:
+            previous_spectrum = spectrum[0]
+        flux = np.diff(spectrum, axis=0, prepend=previous_spectrum[np.newaxis, :])
+        envelope.append(np.maximum(flux, 0.0).sum(axis=1))
+        previous_spectrum = spectrum[-1]
+
+    if not envelope:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(envelope)
+
+
+def normalize_envelope(envelope, frames_per_second):
+    # Remove the slowly moving loudness so quiet and loud passages count the same
+    window_length = max(1, int(frames_per_second))
+    local_mean = np.convolve(envelope, np.ones(window_length) / window_length, mode='same')
+    envelope = np.maximum(envelope - local_mean, 0.0)
+    deviation = envelope.std()
+    return envelope / deviation if deviation > 0 else envelope
+
+
+def estimate_beat_period(envelope, frames_per_second):
+    # Autocorrelation through the FFT, weighted towards BEAT_PREFERRED_BPM
+    size = len(envelope)
+    spectrum = np.fft.rfft(envelope, 2 * size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[:size]
+
+    min_lag = max(1, int(60.0 * frames_per_second / BEAT_MAX_BPM))
+    max_lag = min(size - 2, int(60.0 * frames_per_second / BEAT_MIN_BPM))
+    if max_lag <= min_lag:
+        return None
+
+    lags = np.arange(min_lag, max_lag + 1)
+    preferred_lag = 60.0 * frames_per_second / BEAT_PREFERRED_BPM
+    weights = np.exp(-0.5 * np.log2(lags / preferred_lag) ** 2)
+    best = int(np.argmax(autocorrelation[lags] * weights)) + min_lag
+
+    # Parabolic interpolation, a whole-frame period drifts by several beats over a long track
+    left, center, right = autocorrelation[best - 1], autocorrelation[best], autocorrelation[best + 1]
+    curvature = left - 2 * center + right
+    offset = 0.5 * (left - right) / curvature if curvature < 0 else 0.0
+    return best + float(np.clip(offset, -0.5, 0.5))
+
+
+def track_beats(envelope, frames_per_second):
+    """
+    Place a beat grid on the onset envelope.
+
+    :return: Tuple of (beat frame indices, tempo in BPM), or (empty array, None) for tracks without a pulse.
+    """
+    if len(envelope) < 4:
+        return np.zeros(0, dtype=int), None
+    envelope = normalize_envelope(envelope, frames_per_second)
+    period = estimate_beat_period(envelope, frames_per_second)
+    if period is None:
+        return np.zeros(0, dtype=int), None
+
+    # Pick the grid phase that lands on the most onset energy
+    phases = np.arange(int(np.ceil(period)))
+    beat_numbers = np.arange(int((len(envelope) - 1) / period) + 1)
+    grid = np.rint(phases[:, np.newaxis] + beat_numbers[np.newaxis, :] * period).astype(int)
+    valid = grid < len(envelope)
+    scores = np.where(valid, envelope[np.minimum(grid, len(envelope) - 1)], 0.0).sum(axis=1)
+    beats = grid[int(np.argmax(scores))]
+    beats = beats[beats < len(envelope)]
+
+    # Let every beat move to the strongest onset close by, tempo is never perfectly steady
+    radius = max(1, int(period / 8))
+    offsets = np.arange(-radius, radius + 1)
+    candidates = np.clip(beats[:, np.newaxis] + offsets[np.newaxis, :], 0, len(envelope) - 1)
+    beats = candidates[np.arange(len(beats)), np.argmax(envelope[candidates], axis=1)]
+
+    return np.unique(beats), 60.0 * frames_per_second / period
+
+
+def analyze_beats(filename):
+    """
+    Decode a track and find its beats.
+
+    :param filename: Path to the audio file.
+    :return: Dictionary with the beat times in seconds, the tempo in BPM and the analyzed duration.
+    """
+    frames_per_second = BEAT_SAMPLE_RATE / float(BEAT_HOP_LENGTH)
+    envelope = compute_onset_envelope(iter_pcm_chunks(filename))
+    beat_frames, tempo = track_beats(envelope, frames_per_second)
+    # A frame's flux describes the change into it, so its time is its center
+    beat_times = (beat_frames * BEAT_HOP_LENGTH + BEAT_FRAME_LENGTH / 2.0) / BEAT_SAMPLE_RATE
+    return {
+        'beats': [round(float(beat_time), 3) for beat_time in beat_times],
+        'tempo': round(tempo, 2) if tempo else None,
+        'duration': round(len(envelope) / frames_per_second, 3),
+    }
+
+
+def get_beats(filename, cache_file=None):
+    """
+    Return the beat grid of a track, running the analysis only on a cache miss.
+
+    :param filename: Path to the audio file.
+    :param cache_file: JSON file holding previously found beat grids keyed by content hash.
+    :return: Beat dictionary as returned by analyze_beats, or None if the track could not be decoded.
+    """
+    cache_file = cache_file or BEAT_CACHE_FILE
+    cache_key = f"{get_file_content_hash(filename)}:{BEAT_SAMPLE_RATE}:{BEAT_FRAME_LENGTH}:{BEAT_HOP_LENGTH}"
+    cache = mp4_maker_workspace.load_json_cache(cache_file)
+
+    if cache_key in cache:
+        print(f"Using cached beats for {os.path.basename(filename)}")
+        return dict(cache[cache_key], cached=True)
+
+    print(f"Finding beats in {os.path.basename(filename)}...")
+    try:
+        beats = analyze_beats(filename)
+    except FFmpegRunError as e:
+        print(f"Beat analysis failed for {filename}: {e}")
+        return None
+
+    with mp4_maker_workspace.file_lock(cache_file):
+        cache = mp4_maker_workspace.load_json_cache(cache_file)
+        cache[cache_key] = beats
+        mp4_maker_workspace.save_json_cache(cache, cache_file)
+    return dict(beats, cached=False)
+
+
+def get_fitted_beat_times(beats, fit_options=None):
+    # A looped track repeats its beats, shifted by the track length minus the crossfade each time
+    beat_times = np.asarray(beats['beats'], dtype=float)
+    if not fit_options:
+        return beat_times
+    loop_length = beats['duration'] - fit_options['crossfade_duration']
+    return np.concatenate([beat_times + loop * loop_length for loop in range(fit_options['loop_count'])])
+
+
+def snap_durations_to_beats(beat_times, number_of_images, display_duration_per_image, total_length=None):
+    """
+    Move every cut between two images onto the nearest beat, keeping the total length.
+
+    :param beat_times: Beat positions in seconds, sorted.
+    :param number_of_images: Number of images in the video.
+    :param display_duration_per_image: The regular duration each cut is snapped from.
+    :param total_length: Length of the video, defaults to number_of_images * display_duration_per_image.
+    :return: List with one display duration per image.
+    """
+    total_length = total_length or number_of_images * display_duration_per_image
+    if number_of_images < 2:
+        return [total_length] * number_of_images
+
+    ideal_cuts = np.arange(1, number_of_images) * (total_length / number_of_images)
+    beat_times = np.asarray(beat_times, dtype=float)
+    beat_times = beat_times[(beat_times > 0) & (beat_times < total_length)]
+    if len(beat_times) == 0:
+        return [total_length / number_of_images] * number_of_images
+
+    after = np.clip(np.searchsorted(beat_times, ideal_cuts), 1, len(beat_times) - 1) if len(beat_times) > 1 else np.zeros(len(ideal_cuts), dtype=int)
+    before = np.maximum(after - 1, 0)
+    nearest = np.where(np.abs(beat_times[before] - ideal_cuts) <= np.abs(beat_times[after] - ideal_cuts), beat_times[before], beat_times[after])
+    snapped = np.where(np.abs(nearest - ideal_cuts) <= BEAT_SNAP_WINDOW * display_duration_per_image, nearest, ideal_cuts)
+
+    # Two cuts may snap to the same beat, keep the regular cut wherever a snap would make an image too short
+    min_duration = BEAT_MIN_IMAGE_DURATION * display_duration_per_image
+    cuts = []
+    previous_cut = 0.0
+    for ideal_cut, snapped_cut in zip(ideal_cuts, snapped):
+        cut = snapped_cut if snapped_cut - previous_cut >= min_duration and total_length - snapped_cut >= min_duration else ideal_cut
+        cuts.append(round(float(cut), 3))
+        previous_cut = cut
+
+    boundaries = [0.0] + cuts + [float(total_length)]
+    return [round(end - start, 3) for start, end in zip(boundaries, boundaries[1:])]
@@ -1,9 +1,14 @@
 import os
 import datetime
+import random
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-from openai_utils import create_image
+from openai_utils import create_image, save_b64_image
 import mp4_maker_engine
+import mp4_maker_storyboard
+import mp4_maker_workspace
 import glob
 
 #====GLOBAL VARIABLES====#
@@ -52,7 +57,12 @@ IMAGE_SIZE = "1024x1024"
 MODEL_NAME = "dall-e-3"
 IMAGE_QUALITY = "hd"
 IMAGE_STYLE = "vivid"
+IMAGE_RESPONSE_FORMAT = "b64_json"  # 'b64_json' writes the image straight from the response, 'url' downloads it afterwards
 USER_ID = "unique_user_identifier"
+IMAGE_MAX_IN_FLIGHT = 4  # How many DALL-E generations may run at the same time
+IMAGE_MAX_RETRIES = 5  # Retries per image on 5xx responses and connection errors
+IMAGE_RETRY_BASE_DELAY = 2  # Seconds, doubled on every retry unless the API sends Retry-After
+RETRYABLE_STATUS_CODES = (500, 502, 503, 504)  # 429s are already queued and retried by the quota governor in openai_utils
 
 VIDEO_WIDTH = 1080
 VIDEO_HEIGHT = 1080
@@ -62,14 +72,126 @@ CAPTION_OFFSET_Y = '0.10*h'
 DISPLAY_DURATION_PER_IMAGE = 4
 AUDIO_TRACK_TYPE = 'halloween'
 OUTPUT_FILENAME_PATTERN = 'output_with_captions'
+USE_STORYBOARD = False  # Generate the image descriptions and captions with one chat request instead of the lists above
+STORYBOARD_SCENE_COUNT = 8
+# Extra output sizes rendered in the same ffmpeg run. Leave empty for a single VIDEO_WIDTH x VIDEO_HEIGHT video.
+RENDITIONS = [
+    # {'name': 'square', 'width': 1080, 'height': 1080, 'video_bitrate': '4M', 'profile': 'high', 'preset': 'medium'},
+    # {'name': 'vertical', 'width': 1080, 'height': 1920, 'video_bitrate': '6M', 'profile': 'high', 'preset': 'medium'},
+    # {'name': 'landscape', 'width': 1280, 'height': 720, 'video_bitrate': '3M', 'profile': 'main', 'preset': 'medium'},
+]
+NORMALIZE_AUDIO = True  # EBU R128 loudness normalization of the soundtrack during the final mux
+PREVIEW = os.getenv("MP4_MAKER_PREVIEW", "0") == "1"  # Fast half-size draft with a silent or local audio bed, for checking captions
+PREVIEW_AUDIO_FILE = os.getenv("MP4_MAKER_PREVIEW_AUDIO_FILE")  # Optional local track used as the preview audio bed
+BEAT_SYNC = False  # Move the cuts between images onto the beats of the soundtrack, total length stays the same
+OUTPUT_CONTAINER = 'standard'  # 'faststart' lets players start before the download finishes, 'fragmented' is playable while still being written
+CAPTION_MODE = 'burn'  # 'burn' draws the captions into the frames, 'soft' adds them as switchable subtitle tracks
+CAPTION_VARIANTS = {
+    # Extra caption sets keyed by ISO 639-2 language code, one caption per image like the main captions
+    # 'spa': ["...", "..."],
+}
 
 def download_image(url, dest_folder, filename):
-    response = requests.get(url)
+    response = requests.get(url, timeout=60)
     if response.status_code == 200:
         with open(os.path.join(dest_folder, filename), 'wb') as f:
             f.write(response.content)
+        return True
     else:
         print(f"Error downloading {url}: Status code {response.status_code}")
+        return False
+
+def get_retry_delay(image_response, attempt):
+    retry_after = image_response.get('retry_after')
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass  # HTTP-date form, fall back to our own backoff
+    return IMAGE_RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, 1)
+
+def generate_image(index, image_description, working_directory):
+    # Add CHARACTER_DESCRIPTION and STORYLINE_DESCRIPTION to the prompt
+    image_prompt = f"{CHARACTER_DESCRIPTION.strip()} {STORYLINE_DESCRIPTION.strip()} {image_description.strip()}"
+    filename = f"image_{index:04d}.png"  # Ensure files are named sequentially
+
+    for attempt in range(IMAGE_MAX_RETRIES + 1):
+        image_response = create_image(
+            prompt=image_prompt,
+            model=MODEL_NAME,
+            n=1,
+            quality=IMAGE_QUALITY,
+            response_format=IMAGE_RESPONSE_FORMAT,
+            size=IMAGE_SIZE,
+            style=IMAGE_STYLE,
+            user_id=USER_ID
+        )
+
+        if 'data' in image_response:
+            image_data = image_response['data'][0]
+            if 'cached_path' in image_data:
+                shutil.copyfile(image_data['cached_path'], os.path.join(working_directory, filename))
+                return True
+            if 'b64_json' in image_data:
+                bytes_written = save_b64_image(image_data['b64_json'], os.path.join(working_directory, filename))
+                print(f"Saved {filename} ({bytes_written / 1024:.0f} KiB)")
+                return True
+            # Download right away instead of waiting for the other generations to finish
+            return download_image(image_data['url'], working_directory, filename)
+
+        if image_response.get('cache_miss'):
+            break
+
+        # Connection errors and timeouts carry no status code and are worth another try as well
+        status_code = image_response.get('status_code')
+        if status_code is not None and status_code not in RETRYABLE_STATUS_CODES:
+            break
+        if attempt < IMAGE_MAX_RETRIES:
+            delay = get_retry_delay(image_response, attempt)
+            print(f"Image {index} failed with status {status_code}, retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+
+    print(f"Giving up on image {index}: {image_response.get('error')}")
+    return False
+
+def collect_image_results(futures):
+    failed_indexes = []
+    for future in as_completed(futures):
+        try:
+            if not future.result():
+                failed_indexes.append(futures[future])
+        except requests.exceptions.RequestException as e:
+            print(f"Error downloading image {futures[future]}: {e}")
+            failed_indexes.append(futures[future])
+
+    if failed_indexes:
+        print(f"Failed to generate images: {sorted(failed_indexes)}")
+    return not failed_indexes
+
+def generate_images(image_descriptions, working_directory, max_in_flight=None):
+    with ThreadPoolExecutor(max_workers=max_in_flight or IMAGE_MAX_IN_FLIGHT) as executor:
+        futures = {
+            executor.submit(generate_image, i, image_description, working_directory): i
+            for i, image_description in enumerate(image_descriptions)
+        }
+        return collect_image_results(futures)
+
+def generate_images_from_storyboard(working_directory, number_of_scenes=STORYBOARD_SCENE_COUNT, max_in_flight=None):
+    # Start generating each image as soon as its scene arrives, while the rest of the storyboard is still streaming
+    with ThreadPoolExecutor(max_workers=max_in_flight or IMAGE_MAX_IN_FLIGHT) as executor:
+        futures = {}
+
+        def on_scene(index, scene):
+            print(f"Scene {index}: {scene['description']} -> '{scene['caption']}'")
+            futures[executor.submit(generate_image, index, scene['description'], working_directory)] = index
+
+        scenes = mp4_maker_storyboard.generate_storyboard(CHARACTER_DESCRIPTION, STORYLINE_DESCRIPTION, number_of_scenes, on_scene=on_scene)
+        collect_image_results(futures)
+
+    if scenes is None:
+        # A failed or short storyboard must not turn into a shorter video
+        return [], []
+    return [scene['description'] for scene in scenes], [scene['caption'] for scene in scenes]
 
 def archive_existing_images(base_directory):
     image_files = [f for f in os.listdir(base_directory) if f.endswith((".png", ".jpg", ".jpeg"))]
@@ -90,61 +212,87 @@ def archive_existing_images(base_directory):
 
 
 def get_image_files(folder_path):
-    image_extensions = ('.jpg', '.png', '.jpeg')
-    return sorted(
-        [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith(image_extensions)],
-        key=lambda x: os.path.basename(x).lower()
-    )
+    return mp4_maker_engine.get_image_files(folder_path)
 
-def main():
-    working_directory = os.path.join(os.getcwd(), 'video_images')
-    archive_existing_images(working_directory)
-    os.makedirs(working_directory, exist_ok=True)
+def archive_image_workspace(image_workspace, output_directory, suffix=''):
+    # Keep the generated images next to the videos, under a name no other run can pick
+    os.makedirs(output_directory, exist_ok=True)
+    images_archive = os.path.join(output_directory, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.path.basename(image_workspace)}{suffix}")
+    shutil.move(image_workspace, images_archive)
+    return images_archive
 
-    # Generate images
-    for i, image_description in enumerate(GPT_IMAGE_DESCRIPTION):
-        # Add CHARACTER_DESCRIPTION and STORYLINE_DESCRIPTION to the prompt
-        image_prompt = f"{CHARACTER_DESCRIPTION.strip()} {STORYLINE_DESCRIPTION.strip()} {image_description.strip()}"
+def main(working_directory=None, render_video=True):
+    output_directory = os.path.join(os.getcwd(), 'video_images')
+    image_workspace = None
+    if working_directory:
+        # Caller-owned directory, keep archiving whatever a previous run left there
+        os.makedirs(working_directory, exist_ok=True)
+        archive_existing_images(working_directory)
+    else:
+        # A private directory per run, so concurrent runs never archive or overwrite each other's images
+        image_workspace = mp4_maker_workspace.create_run_workspace(prefix='mp4_maker_images_')
+        working_directory = image_workspace
 
-        image_response = create_image(
-            prompt=image_prompt,
-            model=MODEL_NAME,
-            n=1,
-            quality=IMAGE_QUALITY,
-            response_format="url",
-            size=IMAGE_SIZE,
-            style=IMAGE_STYLE,
-            user_id=USER_ID
-        )
+    published_paths = None
+    try:
+        published_paths = generate_and_render(working_directory, output_directory, render_video)
+        return published_paths
+    finally:
+        # Without a render the caller gets the image paths inside the workspace and owns the directory from here on
+        if image_workspace and render_video:
+            if published_paths:
+                print(f"Moved generated images to {archive_image_workspace(image_workspace, output_directory)}")
+            elif get_image_files(image_workspace):
+                # Images are paid for even when the run fails, keep them for a retry or a manual render
+                print(f"Run failed, kept the generated images in {archive_image_workspace(image_workspace, output_directory, '_failed')}")
+            else:
+                mp4_maker_workspace.remove_run_workspace(image_workspace)
 
-        if 'data' in image_response:
-            image_url = image_response['data'][0]['url']
-            filename = f"image_{i:04d}.png"  # Ensure files are named sequentially
-            download_image(image_url, working_directory, filename)
+def generate_and_render(working_directory, output_directory, render_video):
+    # Generate images, several at a time
+    if USE_STORYBOARD:
+        image_descriptions, video_captions = generate_images_from_storyboard(working_directory)
+    else:
+        image_descriptions, video_captions = GPT_IMAGE_DESCRIPTION, VIDEO_CAPTIONS
+        generate_images(image_descriptions, working_directory)
 
     # Verify that the number of generated images equals the number of descriptions
     generated_image_files = get_image_files(working_directory)
-    if len(GPT_IMAGE_DESCRIPTION) != len(generated_image_files):
-        print(f"The number of generated images ({len(generated_image_files)}) does not match the number of descriptions ({len(GPT_IMAGE_DESCRIPTION)}).")
+    if not image_descriptions or len(image_descriptions) != len(generated_image_files):
+        print(f"The number of generated images ({len(generated_image_files)}) does not match the number of descriptions ({len(image_descriptions)}).")
         return  # Stop the execution if they don't match
 
+    if not render_video:
+        return generated_image_files
+
     caption_properties = {
         'font_size': FONT_SIZE,
         'font_color': FONT_COLOR,
         'caption_offset_y': CAPTION_OFFSET_Y,
     }
 
-    mp4_maker_engine.main(
-        VIDEO_CAPTIONS,
+    published_paths = mp4_maker_engine.main(
+        video_captions,
         working_directory,
         VIDEO_WIDTH,
         VIDEO_HEIGHT,
         caption_properties,
         DISPLAY_DURATION_PER_IMAGE,
         AUDIO_TRACK_TYPE,
-        OUTPUT_FILENAME_PATTERN
+        OUTPUT_FILENAME_PATTERN,
+        normalize_audio=NORMALIZE_AUDIO,
+        renditions=RENDITIONS,
+        output_directory=output_directory,
+        preview=PREVIEW,
+        preview_audio_file=PREVIEW_AUDIO_FILE,
+        beat_sync=BEAT_SYNC,
+        caption_mode=CAPTION_MODE,
+        caption_variants=CAPTION_VARIANTS,
+        output_container=OUTPUT_CONTAINER
     )
 
+    return published_paths
+
 from openai_utils import summarize_and_estimate_cost
 
 summary_data_example = {
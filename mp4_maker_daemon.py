@@ -0,0 +1,357 @@
+# mp4_maker_daemon.py
+#
+# Long-running renderer: watches an inbox for job folders and renders each one on a pool of pre-warmed worker processes.
+#
+# A job folder holds the images (rendered in name order) and either captions.txt (one caption per line)
+# or job.json ({"captions": [...], plus optional mp4_maker_engine.main keyword arguments such as "track_type").
+# Upload into the inbox and the folder is picked up once it stops changing, or right away when a READY file is added.
+#
+#   python mp4_maker_daemon.py --inbox inbox --outbox outbox --workers 2
+
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+import traceback
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Imported up front so forked workers start with every scraper, pytube and ffmpeg module already loaded
+import mp4_maker_engine
+import mp4_maker_configs
+from mp4_maker_fetch_music import get_min_acceptable_length
+import mp4_maker_random_rfm_selector
+
+# ===DAEMON OPTIONS===
+INBOX_DIRECTORY = os.getenv("MP4_MAKER_INBOX", "inbox")
+OUTBOX_DIRECTORY = os.getenv("MP4_MAKER_OUTBOX", "outbox")
+DAEMON_WORKERS = 2  # Renders running at the same time
+DAEMON_POLL_INTERVAL = 0.25  # Seconds between inbox scans, the pick-up latency of a folder with a READY file
+DEBOUNCE_SECONDS = 3.0  # A folder without READY file must stay unchanged this long before it counts as fully uploaded
+READY_FILE = "READY"
+CAPTIONS_FILE = "captions.txt"
+JOB_FILE = "job.json"
+PROCESSING_DIRECTORY = ".processing"  # Claimed jobs, inside the inbox so claiming is a same-filesystem rename
+DONE_DIRECTORY = ".done"
+FAILED_DIRECTORY = ".failed"
+# ===DAEMON OPTIONS===
+
+# ===PREFETCH OPTIONS===
+PREFETCH_ENABLED = True
+PREFETCH_PER_TRACK_TYPE = 1  # Tracks kept ready for each likely track type
+PREFETCH_TRACK_TYPES = 2  # How many of the most requested track types are prefetched
+PREFETCH_HISTORY = 50  # Recent jobs considered when ranking track types
+PREFETCH_LENGTH = 120  # Seconds of audio asked for, longer jobs loop/crossfade or fetch their own
+PREFETCH_RETRY_DELAY = 30  # Seconds before retrying after a failed prefetch
+# ===PREFETCH OPTIONS===
+
+
+def warm_worker():
+    # Runs once in every worker process; with fork the imports above are already done, with spawn they happen here
+    import mp4_maker_engine  # noqa: F401
+    return os.getpid()
+
+
+def create_worker_pool(workers=DAEMON_WORKERS):
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=warm_worker)
+    # Start every process now, so the first job does not pay for it
+    warm_pids = [future.result() for future in [executor.submit(warm_worker) for _ in range(workers)]]
+    print(f"Warmed up {len(set(warm_pids))} worker processes")
+    return executor
+
+
+def get_folder_signature(job_directory):
+    # Cheap enough to run every poll: number of files, total size and newest change
+    file_count, total_size, newest_change = 0, 0, 0.0
+    with os.scandir(job_directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                file_count += 1
+                total_size += stat.st_size
+                newest_change = max(newest_change, stat.st_mtime)
+    return file_count, total_size, newest_change
+
+
+def load_job_options(job_directory):
+    """
+    Read the captions and overrides of a job folder.
+
+    :return: Dictionary of mp4_maker_engine.main keyword arguments (captions_list plus overrides), or None when neither file exists.
+    :raises OSError, ValueError: When a file cannot be read or job.json is not a JSON object.
+    """
+    job_file = os.path.join(job_directory, JOB_FILE)
+    captions_file = os.path.join(job_directory, CAPTIONS_FILE)
+    if os.path.exists(job_file):
+        with open(job_file, 'r') as f:
+            options = json.load(f)
+        if not isinstance(options, dict):
+            raise ValueError(f"{JOB_FILE} must hold a JSON object")
+        options['captions_list'] = options.pop('captions', options.get('captions_list', []))
+        return options
+    if os.path.exists(captions_file):
+        with open(captions_file, 'r', encoding='utf-8') as f:
+            return {'captions_list': [line.strip() for line in f if line.strip()]}
+    return None
+
+
+def is_job_ready(job_directory, pending, now):
+    # An explicit READY file wins, otherwise wait for the upload to settle
+    if os.path.exists(os.path.join(job_directory, READY_FILE)):
+        return True
+    if not (os.path.exists(os.path.join(job_directory, JOB_FILE)) or os.path.exists(os.path.join(job_directory, CAPTIONS_FILE))):
+        return False
+
+    signature = get_folder_signature(job_directory)
+    state = pending.get(job_directory)
+    if state is None or state['signature'] != signature:
+        pending[job_directory] = {'signature': signature, 'stable_since': now}
+        return False
+    return now - state['stable_since'] >= DEBOUNCE_SECONDS
+
+
+def find_ready_jobs(inbox_directory, pending):
+    now = time.time()
+    ready = []
+    with os.scandir(inbox_directory) as entries:
+        for entry in entries:
+            if entry.is_dir() and not entry.name.startswith('.') and is_job_ready(entry.path, pending, now):
+                ready.append(entry.path)
+    # Forget folders that were removed before they became ready
+    for job_directory in [path for path in pending if not os.path.isdir(path)]:
+        del pending[job_directory]
+    return sorted(ready)
+
+
+def build_job_payload(job_options, job_directory, output_directory):
+    # Anything the job folder does not say comes from mp4_maker_configs, like a run of mp4_maker_configs.main
+    payload = {
+        'working_directory': job_directory,
+        'video_width': mp4_maker_configs.VIDEO_WIDTH,
+        'video_height': mp4_maker_configs.VIDEO_HEIGHT,
+        'caption_properties': {
+            'font_size': mp4_maker_configs.FONT_SIZE,
+            'font_color': mp4_maker_configs.FONT_COLOR,
+            'caption_offset_y': mp4_maker_configs.CAPTION_OFFSET_Y,
+        },
+        'display_duration_per_image': mp4_maker_configs.DISPLAY_DURATION_PER_IMAGE,
+        'track_type': mp4_maker_configs.AUDIO_TRACK_TYPE,
+        'output_filename_pattern': mp4_maker_configs.OUTPUT_FILENAME_PATTERN,
+        'normalize_audio': mp4_maker_configs.NORMALIZE_AUDIO,
+        'renditions': mp4_maker_configs.RENDITIONS,
+        'output_directory': output_directory,
+        'caption_mode': mp4_maker_configs.CAPTION_MODE,
+        'caption_variants': mp4_maker_configs.CAPTION_VARIANTS,
+        'output_container': mp4_maker_configs.OUTPUT_CONTAINER,
+    }
+    payload.update(job_options)
+    return payload
+
+
+def render_job(payload):
+    # Runs in a worker process
+    metrics = {}
+    try:
+        published_paths = mp4_maker_engine.main(metrics=metrics, **payload)
+    except (Exception, SystemExit) as e:
+        # The engine still exits on some bad inputs, that must only fail this job
+        return {'ok': False, 'error': f"{type(e).__name__}: {e}\n{traceback.format_exc()}", 'metrics': metrics}
+    return {'ok': True, 'published_paths': published_paths or [], 'metrics': metrics}
+
+
+def start_audio_prefetcher(state):
+    """
+    Keep a few soundtracks downloaded for the track types jobs ask for most.
+
+    :param state: Daemon state dictionary, the prefetcher reads state['recent_track_types'] and fills state['prefetched'].
+    """
+    def prefetch():
+        while not state['stop'].is_set():
+            with state['lock']:
+                ranking = Counter(state['recent_track_types']).most_common(PREFETCH_TRACK_TYPES)
+                track_types = [track_type for track_type, _ in ranking] or [mp4_maker_configs.AUDIO_TRACK_TYPE]
+                missing = [track_type for track_type in track_types if len(state['prefetched'].get(track_type, ())) < PREFETCH_PER_TRACK_TYPE]
+            if not missing:
+                state['stop'].wait(DAEMON_POLL_INTERVAL * 4)
+                continue
+
+            track_type = missing[0]
+            try:
+                track_info = mp4_maker_random_rfm_selector.get_rndm_yt_rfm(PREFETCH_LENGTH, track_type=track_type,
+                                                                           min_acceptable_length=get_min_acceptable_length(PREFETCH_LENGTH, track_type))
+            except Exception as e:
+                track_info = None
+                print(f"Prefetching audio for '{track_type}' failed: {e}")
+            if track_info is None:
+                state['stop'].wait(PREFETCH_RETRY_DELAY)
+                continue
+            with state['lock']:
+                state['prefetched'].setdefault(track_type, deque()).append(dict(track_info, source='prefetch'))
+            print(f"Prefetched '{track_info['title']}' for '{track_type}' jobs")
+
+    thread = threading.Thread(target=prefetch, daemon=True)
+    thread.start()
+    return thread
+
+
+def take_prefetched_track(state, track_type, video_length):
+    # Only hand out a track the engine can fit to this job, anything else fetches its own
+    min_length = get_min_acceptable_length(video_length, track_type) or video_length
+    with state['lock']:
+        state['recent_track_types'].append(track_type)
+        tracks = state['prefetched'].get(track_type)
+        if tracks and tracks[0]['length'] >= min_length and os.path.exists(tracks[0]['file_path']):
+            return tracks.popleft()
+    return None
+
+
+def get_unique_path(directory, name):
+    # A job folder name can come back after its first run was moved away, never merge into or nest under that one
+    path = os.path.join(directory, name)
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{name}.{suffix}")
+        suffix += 1
+    return path
+
+
+def move_job(job_directory, inbox_directory, destination_name, result):
+    # Leaves the outcome next to the job's files and moves the folder out of the way of the next scan
+    destination_root = os.path.join(inbox_directory, destination_name)
+    os.makedirs(destination_root, exist_ok=True)
+    with open(os.path.join(job_directory, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=4)
+    destination = get_unique_path(destination_root, os.path.basename(job_directory))
+    shutil.move(job_directory, destination)
+    return destination
+
+
+def finish_job(future, job_directory, inbox_directory, started_at):
+    job_name = os.path.basename(job_directory)
+    try:
+        result = future.result()
+    except Exception as e:
+        # The worker process itself died
+        result = {'ok': False, 'error': f"{type(e).__name__}: {e}", 'metrics': {}}
+
+    move_job(job_directory, inbox_directory, DONE_DIRECTORY if result['ok'] else FAILED_DIRECTORY, result)
+
+    if result['ok']:
+        print(f"Job {job_name} rendered in {time.time() - started_at:.2f} seconds: {result['published_paths']}")
+    else:
+        print(f"Job {job_name} failed: {result['error'].splitlines()[0]}")
+
+
+def recover_claimed_jobs(inbox_directory):
+    # Jobs claimed by a daemon that died mid-render go back into the inbox to be rendered again
+    processing_directory = os.path.join(inbox_directory, PROCESSING_DIRECTORY)
+    if not os.path.isdir(processing_directory):
+        return
+    for job_name in os.listdir(processing_directory):
+        requeued_directory = get_unique_path(inbox_directory, job_name)
+        os.replace(os.path.join(processing_directory, job_name), requeued_directory)
+        print(f"Requeued interrupted job {job_name} as {os.path.basename(requeued_directory)}")
+
+
+def fail_job(job_directory, inbox_directory, error):
+    failed_directory = move_job(job_directory, inbox_directory, FAILED_DIRECTORY, {'ok': False, 'error': error, 'metrics': {}})
+    print(f"Job {os.path.basename(job_directory)} failed: {error}, moved to {failed_directory}")
+
+
+def dispatch_job(job_directory, state, executor, inbox_directory, outbox_directory):
+    job_name = os.path.basename(job_directory)
+    try:
+        job_options = load_job_options(job_directory)
+    except (OSError, ValueError) as e:
+        # A broken job file would otherwise be read and reported again on every scan
+        fail_job(job_directory, inbox_directory, f"Could not read the job options: {type(e).__name__}: {e}")
+        return
+    if job_options is None:
+        # Only reachable through a READY file, the job would otherwise be picked up again on every scan
+        fail_job(job_directory, inbox_directory, f"Neither {CAPTIONS_FILE} nor {JOB_FILE} found")
+        return
+
+    # Claiming is a rename, so an upload still writing into the old path cannot sneak files into a running render
+    claimed_directory = get_unique_path(os.path.join(inbox_directory, PROCESSING_DIRECTORY), job_name)
+    os.replace(job_directory, claimed_directory)
+    payload = build_job_payload(job_options, claimed_directory, os.path.join(outbox_directory, os.path.basename(claimed_directory)))
+
+    if PREFETCH_ENABLED and not payload.get('preview') and 'track_info' not in payload:
+        number_of_images = min(len(payload['captions_list']), len(mp4_maker_engine.get_image_files(claimed_directory)))
+        track_info = take_prefetched_track(state, payload['track_type'], number_of_images * payload['display_duration_per_image'])
+        if track_info is not None:
+            payload['track_info'] = track_info
+
+    started_at = time.time()
+    try:
+        future = executor.submit(render_job, payload)
+    except BrokenProcessPool:
+        # A worker process died and took the pool with it, give the job back so the next pool renders it
+        if 'track_info' in payload:
+            with state['lock']:
+                state['prefetched'].setdefault(payload['track_type'], deque()).appendleft(payload['track_info'])
+        os.replace(claimed_directory, get_unique_path(inbox_directory, job_name))
+        raise
+    future.add_done_callback(lambda done: finish_job(done, claimed_directory, inbox_directory, started_at))
+    print(f"Dispatched job {job_name}{' with prefetched audio' if 'track_info' in payload else ''}")
+
+
+def run_daemon(inbox_directory=INBOX_DIRECTORY, outbox_directory=OUTBOX_DIRECTORY, workers=DAEMON_WORKERS, stop_event=None):
+    """
+    Watch the inbox and render every job folder that lands in it, until stop_event is set.
+
+    :param inbox_directory: Where job folders are uploaded.
+    :param outbox_directory: Videos are published to <outbox>/<job folder name>.
+    :param workers: Number of worker processes, each renders one job at a time.
+    """
+    for directory in (inbox_directory, os.path.join(inbox_directory, PROCESSING_DIRECTORY), outbox_directory):
+        os.makedirs(directory, exist_ok=True)
+    recover_claimed_jobs(inbox_directory)
+
+    state = {
+        'stop': stop_event or threading.Event(),
+        'lock': threading.Lock(),
+        'recent_track_types': deque(maxlen=PREFETCH_HISTORY),
+        'prefetched': {},
+    }
+    executor = create_worker_pool(workers)
+    if PREFETCH_ENABLED:
+        start_audio_prefetcher(state)
+
+    pending = {}
+    print(f"Watching {os.path.abspath(inbox_directory)} for jobs")
+    try:
+        while not state['stop'].is_set():
+            for job_directory in find_ready_jobs(inbox_directory, pending):
+                pending.pop(job_directory, None)
+                try:
+                    dispatch_job(job_directory, state, executor, inbox_directory, outbox_directory)
+                except BrokenProcessPool:
+                    # Jobs that were running on the old pool fail through their futures, everything else is picked up again
+                    print("A worker process died, starting a new worker pool")
+                    executor.shutdown(wait=False)
+                    executor = create_worker_pool(workers)
+                    break
+                except (OSError, ValueError) as e:
+                    print(f"Could not dispatch {job_directory}: {e}")
+            state['stop'].wait(DAEMON_POLL_INTERVAL)
+    finally:
+        state['stop'].set()
+        executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Watch an inbox for job folders and render them on warm worker processes.")
+    parser.add_argument("--inbox", default=INBOX_DIRECTORY)
+    parser.add_argument("--outbox", default=OUTBOX_DIRECTORY)
+    parser.add_argument("--workers", type=int, default=DAEMON_WORKERS)
+    args = parser.parse_args()
+
+    try:
+        run_daemon(args.inbox, args.outbox, args.workers)
+    except KeyboardInterrupt:
+        print("Stopping, waiting for running renders to finish")
@@ -2,106 +2,552 @@ import ffmpeg
 import os
 import shutil
 from datetime import datetime
-import glob
-from mp4_maker_fetch_music import trim_audio_to_exact_length
+import itertools
+from mp4_maker_fetch_music import trim_audio_to_exact_length, get_audio_fit_options, get_min_acceptable_length, get_audio_length, get_loop_count
 import mp4_maker_random_rfm_selector
+import mp4_maker_loudness
+import mp4_maker_workspace
+import mp4_maker_beats
+import mp4_maker_history
+from mp4_maker_ffmpeg_runner import run_ffmpeg, make_progress_printer, get_audio_stream_info, FFmpegRunError
 import time
 import textwrap
 
 from openai_utils import summarize_and_estimate_cost 
 
+CAPTION_FRAME_TIMEOUT = 120  # Seconds a single caption frame may take before ffmpeg is killed
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg')
+CAPTIONED_FRAME_EXTENSION = '.png'  # Every captioned frame uses one format, whatever mix of sources it came from
+
+# ===OUTPUT CONTAINER OPTIONS===
+CONTAINER_MOVFLAGS = {
+    'standard': None,  # moov atom at the end, the file is only playable once it is complete
+    'faststart': '+faststart',  # moov atom moved to the front after encoding, playback can start while downloading
+    'fragmented': 'frag_keyframe+empty_moov+default_base_moof',  # Playable while it is still being written, works on pipes
+}
+OUTPUT_SINK_NAME = 'pipe:1'  # Reported in place of a published path when the video went to an output sink
+# ===OUTPUT CONTAINER OPTIONS===
+
+# ===AUDIO MUX OPTIONS===
+COPYABLE_AUDIO_CODECS = ('aac',)  # Soundtracks already in one of these go into the MP4 untouched
+COPYABLE_SAMPLE_RATES = (44100, 48000)
+COPYABLE_MAX_CHANNELS = 2
+# ===AUDIO MUX OPTIONS===
+
+# ===CAPTION OPTIONS===
+CAPTION_MODES = ('burn', 'soft')  # Burned into the frames, or a subtitle track the player can switch off
+SUBTITLE_DEFAULT_LANGUAGE = 'eng'  # ISO 639-2 code of the track built from captions_list
+SUBTITLE_SIDECAR_FORMAT = '.vtt'  # Written next to soft-subtitled videos for web players, empty to skip
+# ===CAPTION OPTIONS===
+
+# ===PREVIEW OPTIONS===
+PREVIEW_SCALE = 0.5  # Preview dimensions relative to the final video
+PREVIEW_PRESET = 'ultrafast'
+PREVIEW_CRF = 32  # Visibly lossy but plenty for checking caption copy and placement
+PREVIEW_AUDIO_BITRATE = '64k'
+PREVIEW_SAMPLE_RATE = 44100
+# ===PREVIEW OPTIONS===
+
 
 
 def get_timestamp():
     return datetime.now().strftime('%Y%m%d_%H%M%S')
 
+def iter_image_files(folder_path):
+    # os.scandir hands out entries as it reads the directory instead of building the whole listing first
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield entry.path
+
 def get_image_files(folder_path):
-    image_extensions = ('.jpg', '.png', '.jpeg')
-    return sorted(
-        (file for file in glob.iglob(os.path.join(folder_path, '*'))
-         if file.lower().endswith(image_extensions)),
-        key=lambda x: os.path.basename(x).lower()
+    return sorted(iter_image_files(folder_path), key=lambda x: os.path.basename(x).lower())
+
+def get_frame_filename(index):
+    # Six digits keep the names sorting correctly up to a million frames
+    return f'image{index:06d}{CAPTIONED_FRAME_EXTENSION}'
+
+def fit_to_canvas(stream, video_width, video_height):
+    # Apply filters to scale and add padded background
+    return (
+        stream
+        .filter('scale', width=video_width, height=video_height, force_original_aspect_ratio='decrease')
+        .filter('pad', width=video_width, height=video_height, x='(ow-iw)/2', y='(oh-ih)/2', color='black')
     )
 
-def create_captioned_images(image_files, captions, image_output_dir, video_width, video_height, caption_props):
-    # Calculate max text width for wrapping (a bit less than video width to add padding)
-    max_text_width = int(video_width * 0.95)
+def apply_caption(stream, caption_text, caption_props):
+    wrapped_caption_text = textwrap.fill(caption_text, width=50)  # Wrap text after 50 characters. Adjust as needed.
+
+    # Apply the drawtext filter with text wrapping
+    return stream.filter(
+        'drawtext',
+        text=wrapped_caption_text,
+        fontcolor=caption_props.get('font_color', 'white'),
+        fontsize=caption_props.get('font_size', 36),
+        x='(w-tw)/2',  # Centered text horizontally
+        y=caption_props.get('caption_offset_y', '0.10*h'),  # Positioned text vertically
+        box=1,
+        boxcolor=caption_props.get('box_color', 'black@0.5'),
+        boxborderw=caption_props.get('box_borderw', 5),
+        line_spacing=caption_props.get('line_spacing', 10),  # Optional, adjust line spacing if needed
+        fix_bounds=True,  # Ensures text remains within bounding box
+        # Removed max_text_width, as it's not a valid FFmpeg drawtext option
+    )
 
+def create_captioned_images(image_files, captions, image_output_dir, video_width, video_height, caption_props, frame_stage=None):
+    frame_files = []
     for idx, (image_path, caption_text) in enumerate(zip(image_files, captions)):
         # Print message to console
         print(f"Applying caption '{caption_text}' to the image {os.path.basename(image_path)}")
 
-        wrapped_caption_text = textwrap.fill(caption_text, width=50)  # Wrap text after 50 characters. Adjust as needed.
+        new_filename = get_frame_filename(idx)
+        if frame_stage is not None:
+            new_filepath_with_caption = mp4_maker_workspace.get_frame_path(frame_stage, new_filename)
+        else:
+            new_filepath_with_caption = os.path.join(image_output_dir, new_filename)
 
-        filename = os.path.basename(image_path)
-        new_filename = f'image{idx:04d}{os.path.splitext(filename)[1]}'
-        new_filepath_with_caption = os.path.join(image_output_dir, new_filename)
+        video_filter = fit_to_canvas(ffmpeg.input(image_path), video_width, video_height)
+        video_filter = apply_caption(video_filter, caption_text, caption_props)
 
-        # Apply filters to scale and add padded background
-        video_filter = (
-            ffmpeg
-            .input(image_path)
-            .filter('scale', width=video_width, height=video_height, force_original_aspect_ratio='decrease')
-            .filter('pad', width=video_width, height=video_height, x='(ow-iw)/2', y='(oh-ih)/2', color='black')
-        )
-        
-        # Apply the drawtext filter with text wrapping
-        video_filter = video_filter.filter(
-            'drawtext',
-            text=wrapped_caption_text,
-            fontcolor=caption_props.get('font_color', 'white'),
-            fontsize=caption_props.get('font_size', 36),
-            x='(w-tw)/2',  # Centered text horizontally
-            y=caption_props.get('caption_offset_y', '0.10*h'),  # Positioned text vertically
-            box=1,
-            boxcolor=caption_props.get('box_color', 'black@0.5'),
-            boxborderw=caption_props.get('box_borderw', 5),
-            line_spacing=caption_props.get('line_spacing', 10),  # Optional, adjust line spacing if needed
-            fix_bounds=True,  # Ensures text remains within bounding box
-            # Removed max_text_width, as it's not a valid FFmpeg drawtext option
+        # Now output the image with the caption applied
+        run_ffmpeg(video_filter.output(new_filepath_with_caption).compile(overwrite_output=True), timeout=CAPTION_FRAME_TIMEOUT)
+        if frame_stage is not None:
+            mp4_maker_workspace.commit_frame(frame_stage, new_filepath_with_caption)
+        # Spilled frames are linked into the output directory, so every frame can be read from there
+        frame_files.append(os.path.join(image_output_dir, new_filename))
+
+    return frame_files
+
+def build_fitted_audio_stream(audio_file, fit_options):
+    # Extend a short track to the exact video length inside the mux graph, no re-download needed
+    loop_count = fit_options['loop_count']
+    crossfade_duration = fit_options['crossfade_duration']
+
+    if crossfade_duration > 0:
+        audio_stream = ffmpeg.input(audio_file).audio
+        for _ in range(loop_count - 1):
+            audio_stream = ffmpeg.filter([audio_stream, ffmpeg.input(audio_file).audio], 'acrossfade', d=crossfade_duration)
+    else:
+        audio_stream = ffmpeg.input(audio_file, stream_loop=loop_count - 1).audio
+
+    return (
+        audio_stream
+        .filter('atrim', duration=fit_options['target_length'])
+        .filter('asetpts', 'PTS-STARTPTS')
+    )
+
+def build_audio_stream(audio_file, audio_options=None):
+    audio_options = audio_options or {}
+    if audio_file is None:
+        # Silent bed for previews rendered without a soundtrack
+        return ffmpeg.input(f"anullsrc=channel_layout=stereo:sample_rate={PREVIEW_SAMPLE_RATE}", f='lavfi', t=audio_options['silence_duration']).audio
+
+    audio_stream = ffmpeg.input(audio_file).audio
+
+    fit_options = audio_options.get('fit')
+    if fit_options:
+        audio_stream = build_fitted_audio_stream(audio_file, fit_options)
+
+    loudnorm_options = audio_options.get('loudnorm')
+    if loudnorm_options:
+        audio_stream = (
+            audio_stream
+            .filter('loudnorm', **loudnorm_options)
+            .filter('aresample', mp4_maker_loudness.NORMALIZED_SAMPLE_RATE)
         )
 
-        # Now output the image with the caption applied
-        video_filter.output(new_filepath_with_caption).run(overwrite_output=True)
-        
+    return audio_stream
+
+def write_concat_list(image_files, image_durations, list_path):
+    """
+    Write an ffconcat list showing every image for its own duration.
+
+    Entries are written as they come, so image_files and image_durations may be generators of any length.
+    The concat demuxer shows each frame once for its duration, nothing is duplicated to fill the time.
+
+    :return: Tuple of (list_path, number of images written).
+    """
+    def quote(path):
+        return "'" + os.path.abspath(path).replace("'", "'\\''") + "'"
+
+    image_count = 0
+    last_image_path = None
+    with open(list_path, 'w') as f:
+        f.write("ffconcat version 1.0\n")
+        for image_path, duration in zip(image_files, image_durations):
+            f.write(f"file {quote(image_path)}\nduration {duration:.3f}\n")
+            image_count += 1
+            last_image_path = image_path
+        # The last duration is only honored when another entry follows it
+        if last_image_path is not None:
+            f.write(f"file {quote(last_image_path)}\n")
+    return list_path, image_count
+
+def choose_audio_path(audio_file, audio_options=None):
+    """
+    Decide whether the soundtrack can be stream-copied into the output or has to be encoded.
+
+    :return: Dictionary with 'copy' (bool) and a human readable 'description' of the decision.
+    """
+    audio_options = audio_options or {}
+    if audio_file is None:
+        return {'copy': False, 'description': 'encode to AAC (silent bed)'}
+    # Any filter in the audio chain means decoded samples, and those have to be encoded again
+    filters = [name for name in ('fit', 'loudnorm') if audio_options.get(name)]
+    if filters:
+        return {'copy': False, 'description': f"encode to AAC ({' and '.join(filters)} filtering)"}
 
-def generate_video_from_images(image_output_dir, audio_file, output_path, display_duration_per_image):
     try:
-        framerate = 1.0 / display_duration_per_image
-        ext = next((f for f in os.listdir(image_output_dir) if f.lower().endswith(('.jpg', '.png', '.jpeg'))), None)
-        if ext is None:
-            print("No images found to create video.")
-            return
-
-        ext = os.path.splitext(ext)[1]
-        input_pattern = os.path.join(image_output_dir, 'image%04d' + ext)
-
-        input_stream = ffmpeg.input(input_pattern, framerate=framerate, pattern_type='sequence')
-        audio_stream = ffmpeg.input(audio_file)
-        output_stream = ffmpeg.output(input_stream, audio_stream, output_path, pix_fmt='yuv420p', vcodec='libx264', acodec='aac', shortest=None)
-        
-        ffmpeg.run(output_stream)
-        
-    except ffmpeg.Error as e:
-        print("An FFmpeg error occurred while creating the video: ", e.stderr)
-        exit(1)
-    except Exception as e:
-        print("An unexpected error occurred while creating the video: ", e)
-        exit(1)
+        stream_info = get_audio_stream_info(audio_file)
+    except FFmpegRunError as e:
+        print(f"Could not probe {audio_file}, encoding its audio: {e}")
+        return {'copy': False, 'description': 'encode to AAC (probe failed)'}
+    if stream_info is None:
+        return {'copy': False, 'description': 'encode to AAC (no audio stream found)'}
+
+    stream_description = f"{stream_info['codec_name']} {stream_info['sample_rate']}Hz {stream_info['channels']}ch"
+    compatible = (
+        stream_info['codec_name'] in COPYABLE_AUDIO_CODECS
+        and stream_info['sample_rate'] in COPYABLE_SAMPLE_RATES
+        and 0 < stream_info['channels'] <= COPYABLE_MAX_CHANNELS
+    )
+    if compatible:
+        return {'copy': True, 'description': f"stream copy ({stream_description})"}
+    return {'copy': False, 'description': f"encode to AAC (source is {stream_description})"}
+
+def get_container_output_kwargs(container='standard', piped=False):
+    if container not in CONTAINER_MOVFLAGS:
+        raise ValueError(f"Unknown output container {container!r}, expected one of {tuple(CONTAINER_MOVFLAGS)}")
+    if piped and container != 'fragmented':
+        # A pipe cannot be seeked back into, so only a fragmented MP4 can be written to it
+        print(f"Writing a fragmented MP4 instead of '{container}' to the output sink")
+        container = 'fragmented'
+
+    output_kwargs = {}
+    if CONTAINER_MOVFLAGS[container]:
+        output_kwargs['movflags'] = CONTAINER_MOVFLAGS[container]
+    if piped:
+        output_kwargs['f'] = 'mp4'
+    return output_kwargs
+
+def generate_video_from_images(image_output_dir, audio_file, output_path, display_duration_per_image, audio_options=None, total_duration=None, image_durations=None, image_files=None, container='standard', output_sink=None):
+    """
+    Encode a slideshow from a directory of frames through a concat list.
+
+    :param image_output_dir: Directory holding the frames, read in name order when image_files is not given.
+    :param output_path: Output file, with output_sink only used to place the concat list next to it.
+    :param image_files: Optional frames in display order, any mix of image formats and any number of them.
+    :param image_durations: Optional display duration per image, overrides display_duration_per_image.
+    :param container: 'standard', 'faststart' or 'fragmented' MP4.
+    :param output_sink: Optional file-like object the video is streamed to while it encodes, nothing is written to output_path.
+    """
+    if image_files is None:
+        image_files = get_image_files(image_output_dir)
+    durations = image_durations or itertools.repeat(display_duration_per_image)
+
+    list_path, image_count = write_concat_list(image_files, durations, f"{output_path}.ffconcat")
+    if image_count == 0:
+        print("No images found to create video.")
+        return
+
+    audio_path = choose_audio_path(audio_file, audio_options)
+    print(f"Audio: {audio_path['description']}")
+    input_stream = ffmpeg.input(list_path, f='concat', safe=0)
+    audio_stream = ffmpeg.input(audio_file).audio if audio_path['copy'] else build_audio_stream(audio_file, audio_options)
+    output_stream = ffmpeg.output(input_stream, audio_stream, OUTPUT_SINK_NAME if output_sink is not None else output_path,
+                                  pix_fmt='yuv420p', vcodec='libx264', acodec='copy' if audio_path['copy'] else 'aac', shortest=None, vsync='vfr',
+                                  **get_container_output_kwargs(container, piped=output_sink is not None))
+
+    # Raises FFmpegRunError with the captured stderr if ffmpeg fails, hangs or runs past its deadline
+    run_ffmpeg(ffmpeg.compile(output_stream, overwrite_output=True), total_duration=total_duration,
+               on_progress=make_progress_printer("Encoding video"), output_sink=output_sink)
+    return audio_path
+
+def get_rendition_name(rendition):
+    return rendition.get('name') or f"{rendition['width']}x{rendition['height']}"
+
+def get_rendition_output_kwargs(rendition):
+    output_kwargs = {
+        'pix_fmt': 'yuv420p',
+        'vcodec': rendition.get('vcodec', 'libx264'),
+        'acodec': 'aac',
+        'preset': rendition.get('preset', 'medium'),
+    }
+    if rendition.get('video_bitrate'):
+        output_kwargs['b:v'] = rendition['video_bitrate']
+    if rendition.get('profile'):
+        output_kwargs['profile:v'] = rendition['profile']
+    if rendition.get('crf') is not None:
+        output_kwargs['crf'] = rendition['crf']
+    if rendition.get('audio_bitrate'):
+        output_kwargs['b:a'] = rendition['audio_bitrate']
+    return output_kwargs
+
+def generate_renditions_from_images(image_files, captions, audio_file, output_paths, renditions, display_duration_per_image, caption_props, audio_options=None, image_durations=None, caption_variants=None, subtitle_files=None, container='standard', output_sink=None):
+    """
+    Render every rendition of the slideshow in a single ffmpeg run.
+
+    :return: The audio path taken, see choose_audio_path.
+
+    Each source image is decoded once and split into one scale/pad chain per rendition, and every caption
+    variant only adds its own caption layer on top of that shared base. The audio chain (fit, loudness)
+    is built once and split across the outputs.
+
+    :param image_files: Source images, in display order.
+    :param captions: One caption per image, None (or a None entry) leaves the images uncaptioned.
+    :param output_paths: One output path per rendition, or per rendition and caption variant (rendition by rendition).
+    :param renditions: List of dicts with 'width' and 'height', optionally 'video_bitrate', 'audio_bitrate',
+                       'profile', 'preset', 'vcodec' and 'caption_properties' overrides.
+    :param image_durations: Optional display duration per image, overrides display_duration_per_image.
+    :param caption_variants: Optional list of caption lists burned into separate outputs, replaces captions.
+    :param subtitle_files: Optional list of (path, language) pairs muxed into every output as soft subtitle tracks.
+    :param container: 'standard', 'faststart' or 'fragmented' MP4.
+    :param output_sink: Optional file-like object the only output is streamed to instead of its output path.
+    """
+    image_durations = image_durations or [display_duration_per_image] * len(image_files)
+    caption_variants = caption_variants or [captions]
+    subtitle_files = subtitle_files or []
+    variant_branches = [[[] for _ in caption_variants] for _ in renditions]
+
+    for image_index, (image_path, image_duration) in enumerate(zip(image_files, image_durations)):
+        print(f"Preparing the image {os.path.basename(image_path)} for {len(renditions)} renditions and {len(caption_variants)} caption variants")
+        # One frame per image, shown for as long as that image stays on screen
+        image_stream = ffmpeg.input(image_path, loop=1, t=image_duration, framerate=1.0 / image_duration)
+        image_split = image_stream.filter_multi_output('split', len(renditions))
+
+        for rendition_index, rendition in enumerate(renditions):
+            rendition_caption_props = dict(caption_props, **rendition.get('caption_properties', {}))
+            base = fit_to_canvas(image_split.stream(rendition_index), rendition['width'], rendition['height'])
+            if len(caption_variants) > 1:
+                base_split = base.filter_multi_output('split', len(caption_variants))
+                bases = [base_split.stream(variant_index) for variant_index in range(len(caption_variants))]
+            else:
+                bases = [base]
+
+            for variant_index, variant_captions in enumerate(caption_variants):
+                branch = bases[variant_index]
+                caption_text = variant_captions[image_index] if variant_captions and image_index < len(variant_captions) else None
+                if caption_text:
+                    branch = apply_caption(branch, caption_text, rendition_caption_props)
+                # concat needs every segment to share the same sample aspect ratio
+                variant_branches[rendition_index][variant_index].append(branch.filter('setsar', 1))
+
+    outputs = [(rendition, variant_branches[rendition_index][variant_index])
+               for rendition_index, rendition in enumerate(renditions)
+               for variant_index in range(len(caption_variants))]
+    if output_sink is not None and len(outputs) > 1:
+        raise ValueError(f"An output sink takes a single output, this run has {len(outputs)}")
+    audio_path = choose_audio_path(audio_file, audio_options)
+    print(f"Audio: {audio_path['description']}")
+    if audio_path['copy']:
+        # An unfiltered input stream can be mapped into every output as it is
+        audio_source = ffmpeg.input(audio_file).audio
+        audio_streams = [audio_source] * len(outputs)
+    else:
+        audio_split = build_audio_stream(audio_file, audio_options).filter_multi_output('asplit', len(outputs))
+        audio_streams = [audio_split.stream(output_index) for output_index in range(len(outputs))]
+
+    subtitle_streams = [ffmpeg.input(subtitle_path)['s'] for subtitle_path, _ in subtitle_files]
+    subtitle_kwargs = {}
+    if subtitle_files:
+        subtitle_kwargs['scodec'] = 'mov_text'
+        for subtitle_index, (_, language) in enumerate(subtitle_files):
+            subtitle_kwargs[f'metadata:s:s:{subtitle_index}'] = f'language={language}'
+
+    output_streams = []
+    for output_index, ((rendition, branches), output_path) in enumerate(zip(outputs, output_paths)):
+        video_stream = ffmpeg.concat(*branches, v=1, a=0)
+        output_kwargs = get_rendition_output_kwargs(rendition)
+        output_kwargs.update(get_container_output_kwargs(container, piped=output_sink is not None))
+        if audio_path['copy']:
+            output_kwargs['acodec'] = 'copy'
+            output_kwargs.pop('b:a', None)
+        output_streams.append(ffmpeg.output(
+            video_stream, audio_streams[output_index], *subtitle_streams, OUTPUT_SINK_NAME if output_sink is not None else output_path,
+            shortest=None, vsync='vfr', **output_kwargs, **subtitle_kwargs
+        ))
+
+    run_ffmpeg(ffmpeg.compile(ffmpeg.merge_outputs(*output_streams), overwrite_output=True),
+               total_duration=sum(image_durations),
+               on_progress=make_progress_printer(f"Encoding {len(outputs)} outputs"), output_sink=output_sink)
+    return audio_path
+
+def format_subtitle_timestamp(seconds, decimal_separator):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{decimal_separator}{milliseconds:03d}"
+
+def write_subtitle_file(captions, image_durations, subtitle_path):
+    """
+    Write one cue per image, timed like the slideshow.
+
+    :param captions: One caption per image.
+    :param image_durations: Display duration of every image.
+    :param subtitle_path: Output file, .vtt writes WebVTT, anything else SubRip.
+    """
+    is_webvtt = subtitle_path.lower().endswith('.vtt')
+    decimal_separator = '.' if is_webvtt else ','
+    cues = []
+    start = 0.0
+    for caption_text, duration in zip(captions, image_durations):
+        end = start + duration
+        if caption_text:
+            cue = f"{format_subtitle_timestamp(start, decimal_separator)} --> {format_subtitle_timestamp(end, decimal_separator)}\n{textwrap.fill(caption_text, width=50)}"
+            # SubRip numbers its cues, WebVTT does not need to
+            cues.append(cue if is_webvtt else f"{len(cues) + 1}\n{cue}")
+        start = end
+
+    with open(subtitle_path, 'w', encoding='utf-8') as f:
+        if is_webvtt:
+            f.write("WEBVTT\n\n")
+        f.write("\n\n".join(cues) + "\n")
+    return subtitle_path
 
 def cleanup(image_output_dir, audio_file):
     try:
-        if os.path.exists(image_output_dir):
+        if image_output_dir and os.path.exists(image_output_dir):
             shutil.rmtree(image_output_dir)
-        if os.path.exists(audio_file):    
+        if audio_file and os.path.exists(audio_file):    
             os.remove(audio_file)
     except OSError as e:
         print(f"An error occurred while cleaning up files: {e.strerror}")
         exit(1)
 
-def main(captions_list, working_directory, video_width, video_height, caption_properties, display_duration_per_image, track_type, output_filename_pattern):    
+def prepare_soundtrack(workspace, video_length_in_seconds, track_type, normalize_audio, track_info=None):
+    """
+    Fetch (unless track_info is given), normalize and fit a soundtrack for the video.
+
+    :return: Dictionary with track_info, audio_file, audio_options, audio_normalization and audio_fit.
+    """
+    #get audio infos
+    fit_options = get_audio_fit_options(track_type)
+    min_acceptable_length = get_min_acceptable_length(video_length_in_seconds, track_type)
+    if track_info is None:
+        track_info = mp4_maker_random_rfm_selector.get_rndm_yt_rfm(video_length_in_seconds, track_type=track_type, min_acceptable_length=min_acceptable_length)
+        audio_source = 'cache' if track_info.get('cached') else 'download'
+    else:
+        audio_source = track_info.get('source', 'local')
+    # Trimming rewrites the file, so work on a private copy instead of the shared audio cache,
+    # taken under the track's lock so no other run can replace or remove it halfway through the copy
+    with mp4_maker_workspace.file_lock(mp4_maker_random_rfm_selector.get_track_lock_path(track_info['file_path'])):
+        audio_file = mp4_maker_workspace.copy_to_workspace(track_info['file_path'], workspace)
+
+    # Measure loudness on the untrimmed track so the cached stats are reused across renders of any length
+    audio_options = {}
+    audio_normalization = 'disabled'
+    loudness_cached = None
+    if normalize_audio:
+        loudness_stats = mp4_maker_loudness.get_loudness_stats(audio_file)
+        if loudness_stats:
+            loudness_cached = loudness_stats['cached']
+            audio_options['loudnorm'] = mp4_maker_loudness.get_loudnorm_filter_options(loudness_stats)
+            audio_normalization = f"{loudness_stats['input_i']} LUFS -> {mp4_maker_loudness.LOUDNESS_TARGET_I} LUFS"
+        else:
+            audio_normalization = 'skipped (analysis failed)'
+
+    if not trim_audio_to_exact_length(audio_file, video_length_in_seconds, allow_shorter=min_acceptable_length is not None):
+        print("Unable to trim audio to exact length. Please check the audio file.")
+        exit(1)
+
+    audio_fit = 'trimmed'
+    audio_length = get_audio_length(audio_file)
+    if audio_length < video_length_in_seconds:
+        # Never let the fades eat more than half of the track
+        crossfade_duration = min(fit_options['crossfade_duration'], audio_length / 2) if fit_options['mode'] == 'crossfade' else 0
+        loop_count = get_loop_count(audio_length, video_length_in_seconds, crossfade_duration)
+        audio_options['fit'] = {
+            'loop_count': loop_count,
+            'crossfade_duration': crossfade_duration,
+            'target_length': video_length_in_seconds,
+        }
+        audio_fit = f"{fit_options['mode']} x{loop_count} ({crossfade_duration}s crossfade)"
+
+    return {
+        'track_info': track_info,
+        'audio_file': audio_file,
+        'audio_options': audio_options,
+        'audio_normalization': audio_normalization,
+        'audio_fit': audio_fit,
+        'audio_source': audio_source,
+        'loudness_cached': loudness_cached,
+    }
+
+
+def prepare_preview_soundtrack(workspace, video_length_in_seconds, track_type, preview_audio_file=None):
+    # A local track when one is given, otherwise a silent bed; previews never wait on the network
+    if preview_audio_file:
+        track_info = {
+            'title': 'Preview audio bed',
+            'link': None,
+            'length': get_audio_length(preview_audio_file),
+            'file_path': preview_audio_file,
+        }
+        return prepare_soundtrack(workspace, video_length_in_seconds, track_type, False, track_info)
+
+    return {
+        'track_info': {'title': 'Silence', 'link': None, 'length': video_length_in_seconds, 'file_path': None},
+        'audio_file': None,
+        'audio_options': {'silence_duration': video_length_in_seconds},
+        'audio_normalization': 'disabled',
+        'audio_fit': 'silent preview bed',
+        'audio_source': 'silence',
+        'loudness_cached': None,
+    }
+
+def get_preview_rendition(video_width, video_height, caption_properties):
+    # Keep dimensions even for yuv420p and scale the caption metrics so text lands where it will in the final render
+    preview_width = int(video_width * PREVIEW_SCALE) // 2 * 2
+    preview_height = int(video_height * PREVIEW_SCALE) // 2 * 2
+    preview_caption_properties = {
+        'font_size': caption_properties.get('font_size', 36) * PREVIEW_SCALE,
+        'box_borderw': max(1, int(caption_properties.get('box_borderw', 5) * PREVIEW_SCALE)),
+        'line_spacing': caption_properties.get('line_spacing', 10) * PREVIEW_SCALE,
+    }
+    caption_offset_y = caption_properties.get('caption_offset_y', '0.10*h')
+    if isinstance(caption_offset_y, (int, float)):
+        preview_caption_properties['caption_offset_y'] = caption_offset_y * PREVIEW_SCALE
+
+    return {
+        'name': 'preview',
+        'width': preview_width,
+        'height': preview_height,
+        'preset': PREVIEW_PRESET,
+        'crf': PREVIEW_CRF,
+        'audio_bitrate': PREVIEW_AUDIO_BITRATE,
+        'caption_properties': preview_caption_properties,
+    }
+
+def publish_outputs(output_paths, output_directory, output_sink=None):
+    # A streamed video already went to its sink, there is no file to publish
+    if output_sink is not None:
+        return [OUTPUT_SINK_NAME]
+    return [mp4_maker_workspace.publish_output(output_path, output_directory) for output_path in output_paths]
+
+def record_stage(metrics, stage_name, stage_start):
+    # Wall time per stage, stored in the run history and reported back to the job queue by render workers
+    metrics.setdefault('stages', {})[stage_name] = round(time.time() - stage_start, 3)
+    return time.time()
+
+def main(captions_list, working_directory, video_width, video_height, caption_properties, display_duration_per_image, track_type, output_filename_pattern, normalize_audio=False, renditions=None, output_directory=None, preview=False, preview_audio_file=None, beat_sync=False, caption_mode='burn', caption_variants=None, metrics=None, output_container='standard', output_sink=None, track_info=None):
+    # Every run renders inside its own scratch workspace, so several renders can share a host
+    workspace = mp4_maker_workspace.create_run_workspace()
+    frame_stages = []
+    try:
+        return render_in_workspace(workspace, frame_stages, captions_list, working_directory, video_width, video_height, caption_properties, display_duration_per_image, track_type, output_filename_pattern, normalize_audio, renditions, output_directory or working_directory, preview, preview_audio_file, beat_sync, caption_mode, caption_variants, metrics, output_container, output_sink, track_info)
+    finally:
+        for frame_stage in frame_stages:
+            mp4_maker_workspace.remove_frame_stage(frame_stage)
+        mp4_maker_workspace.remove_run_workspace(workspace)
+
+def render_in_workspace(workspace, frame_stages, captions_list, working_directory, video_width, video_height, caption_properties, display_duration_per_image, track_type, output_filename_pattern, normalize_audio, renditions, output_directory, preview=False, preview_audio_file=None, beat_sync=False, caption_mode='burn', caption_variants=None, metrics=None, output_container='standard', output_sink=None, track_info=None):
     
     start_time = time.time()  # Start timing the script execution
+    # Filled in on every run, the history records it even when the caller did not ask for it
+    metrics = metrics if metrics is not None else {}
+    cpu_start = mp4_maker_history.get_cpu_seconds()
+    stage_start = start_time
     summary_data = {
         'audio_file': None,
         'output_file': None,
@@ -132,30 +578,113 @@ def main(captions_list, working_directory, video_width, video_height, caption_pr
         image_files = image_files[:min_count]
 
 
-    # Create captioned images directory inside working directory
-    captioned_images_directory = os.path.join(working_directory, 'captioned_video_images')
-    os.makedirs(captioned_images_directory, exist_ok=True)
+    # Only the burn-in path writes intermediate frames, every other path draws inside the ffmpeg run
+    frame_stage = None
     #assert len(captions_list) == len(image_files), "Number of captions does not match the number of images."
     video_length_in_seconds = len(image_files) * display_duration_per_image
-
-    #get audio infos
-    track_info = mp4_maker_random_rfm_selector.get_rndm_yt_rfm(video_length_in_seconds, track_type=track_type)    
-    audio_file = track_info['file_path']
-    summary_data['audio_file'] = audio_file
-
-
-    if not trim_audio_to_exact_length(audio_file, video_length_in_seconds):
-        print("Unable to trim audio to exact length. Please check the audio file.")
-        exit(1)
-
-    create_captioned_images(image_files, captions_list, captioned_images_directory, video_width, video_height, caption_properties)
-    # Create the output file path
-    output_file = f'{get_timestamp()}_{output_filename_pattern}.mp4'
-    output_path = os.path.join(working_directory, output_file)
-
-    # Generate the video, afterwards we have a complete video length
-    generate_video_from_images(captioned_images_directory, audio_file, output_path, display_duration_per_image)
+    stage_start = record_stage(metrics, 'prepare', stage_start)
+
+    if preview:
+        # Same caption layout at a fraction of the size, one fast ffmpeg run and no network round-trip for audio
+        renditions = [get_preview_rendition(video_width, video_height, caption_properties)]
+        soundtrack = prepare_preview_soundtrack(workspace, video_length_in_seconds, track_type, preview_audio_file)
+    else:
+        # A track_info handed in (e.g. prefetched by the daemon) skips the music fetch
+        soundtrack = prepare_soundtrack(workspace, video_length_in_seconds, track_type, normalize_audio, track_info)
+    track_info = soundtrack['track_info']
+    audio_file = soundtrack['audio_file']
+    audio_options = soundtrack['audio_options']
+    audio_normalization = soundtrack['audio_normalization']
+    audio_fit = soundtrack['audio_fit']
+    summary_data['audio_file'] = track_info['file_path']
+    stage_start = record_stage(metrics, 'audio', stage_start)
+
+    image_durations = None
+    beats_cached = None
+    image_cuts = f"every {display_duration_per_image} seconds"
+    if beat_sync and track_info['file_path']:
+        # Analyze the untrimmed track so the cached beats are reused across renders of any length
+        beats = mp4_maker_beats.get_beats(track_info['file_path'])
+        beats_cached = beats['cached'] if beats else None
+        if beats and beats['beats']:
+            beat_times = mp4_maker_beats.get_fitted_beat_times(beats, audio_options.get('fit'))
+            image_durations = mp4_maker_beats.snap_durations_to_beats(beat_times, len(image_files), display_duration_per_image, video_length_in_seconds)
+            image_cuts = f"on the beat ({beats['tempo']} BPM), {min(image_durations)}-{max(image_durations)} seconds per image"
+        else:
+            image_cuts += " (beat analysis found no beats)"
+        stage_start = record_stage(metrics, 'beats', stage_start)
+
+    if caption_mode not in CAPTION_MODES:
+        raise ValueError(f"Unknown caption mode {caption_mode!r}, expected one of {CAPTION_MODES}")
+
+    if caption_mode == 'soft' or caption_variants:
+        # The frames are scaled once per rendition, captions either ride along as subtitle tracks or only add their own layer
+        language_captions = {SUBTITLE_DEFAULT_LANGUAGE: captions_list}
+        language_captions.update(caption_variants or {})
+        output_renditions = renditions or [{'width': video_width, 'height': video_height}]
+        subtitle_durations = image_durations or [display_duration_per_image] * len(image_files)
+        timestamp = get_timestamp()
+
+        def get_output_file(rendition, language=None):
+            # Without explicit renditions the file names stay as they were, only the language is added
+            name_parts = [timestamp, output_filename_pattern, get_rendition_name(rendition) if renditions else None, language]
+            return '_'.join(part for part in name_parts if part) + '.mp4'
+
+        subtitle_files = []
+        if caption_mode == 'soft':
+            for language, language_captions_list in language_captions.items():
+                subtitle_path = os.path.join(workspace, f"{timestamp}_{output_filename_pattern}_{language}.srt")
+                write_subtitle_file(language_captions_list, subtitle_durations, subtitle_path)
+                subtitle_files.append((subtitle_path, language))
+            output_files = [get_output_file(rendition) for rendition in output_renditions]
+            variants = None
+        else:
+            output_files = [get_output_file(rendition, language) for rendition in output_renditions for language in language_captions]
+            variants = list(language_captions.values())
+
+        output_paths = [os.path.join(workspace, output_file) for output_file in output_files]
+        audio_path = generate_renditions_from_images(image_files, None, audio_file, output_paths, output_renditions, display_duration_per_image, caption_properties, audio_options, image_durations,
+                                        caption_variants=variants, subtitle_files=subtitle_files, container=output_container, output_sink=output_sink)
+        published_paths = publish_outputs(output_paths, output_directory, output_sink)
+
+        if caption_mode == 'soft' and SUBTITLE_SIDECAR_FORMAT:
+            for language, language_captions_list in language_captions.items():
+                sidecar_path = os.path.join(workspace, f"{timestamp}_{output_filename_pattern}_{language}{SUBTITLE_SIDECAR_FORMAT}")
+                write_subtitle_file(language_captions_list, subtitle_durations, sidecar_path)
+                published_paths.append(mp4_maker_workspace.publish_output(sidecar_path, output_directory))
+
+        output_file = ', '.join(os.path.basename(path) for path in published_paths)
+        video_size = ', '.join(f"{rendition['width']}x{rendition['height']}" for rendition in output_renditions)
+    elif renditions:
+        # Every rendition comes out of one ffmpeg run, the captions are drawn inside that run
+        timestamp = get_timestamp()
+        output_files = [f"{timestamp}_{output_filename_pattern}_{get_rendition_name(rendition)}.mp4" for rendition in renditions]
+        output_paths = [os.path.join(workspace, output_file) for output_file in output_files]
+        audio_path = generate_renditions_from_images(image_files, captions_list, audio_file, output_paths, renditions, display_duration_per_image, caption_properties, audio_options, image_durations,
+                                                     container=output_container, output_sink=output_sink)
+        published_paths = publish_outputs(output_paths, output_directory, output_sink)
+        output_file = ', '.join(output_files)
+        video_size = ', '.join(f"{rendition['width']}x{rendition['height']}" for rendition in renditions)
+    else:
+        # Create the captioned images directory, in RAM when there is room for it, otherwise inside the run workspace
+        estimated_frame_bytes = len(image_files) * video_width * video_height * 3
+        frame_stage = mp4_maker_workspace.create_frame_stage(workspace, 'captioned_video_images', estimated_frame_bytes)
+        frame_stages.append(frame_stage)
+        captioned_images_directory = frame_stage['directory']
+        frame_files = create_captioned_images(image_files, captions_list, captioned_images_directory, video_width, video_height, caption_properties, frame_stage)
+        # Create the output file path
+        output_file = f'{get_timestamp()}_{output_filename_pattern}.mp4'
+        output_path = os.path.join(workspace, output_file)
+
+        # Generate the video, afterwards we have a complete video length
+        audio_path = generate_video_from_images(captioned_images_directory, audio_file, output_path, display_duration_per_image, audio_options, total_duration=video_length_in_seconds, image_durations=image_durations, image_files=frame_files,
+                                                container=output_container, output_sink=output_sink)
+        # Readers of the output directory only ever see the finished file
+        published_paths = publish_outputs([output_path], output_directory, output_sink)
+        video_size = f"{video_width}x{video_height}"
     
+    stage_start = record_stage(metrics, 'render', stage_start)
+
     # Calculate total video length using 'display_duration_per_image' and the total number of images
     total_video_length = display_duration_per_image * len(image_files)  # in seconds
 
@@ -163,7 +692,6 @@ def main(captions_list, working_directory, video_width, video_height, caption_pr
     end_time = time.time()
     elapsed_time = end_time - start_time
     number_of_images = len(image_files)
-    video_size = f"{video_width}x{video_height}"
     summary_data['output_file'] = output_file
 
 
@@ -181,23 +709,60 @@ def main(captions_list, working_directory, video_width, video_height, caption_pr
     ===SUMMARY===
     Execution Time: {elapsed_time:.2f} seconds
     Working Directory: {working_directory}
+    Run Workspace: {workspace}
+    Frame Scratch: {mp4_maker_workspace.describe_frame_stage(frame_stage) if frame_stage else 'none, frames drawn inside ffmpeg'}
+    Output Directory: {output_directory}
     Number of Images: {number_of_images}
     Total Video Length: {total_video_length} seconds
     Video Dimensions: {video_size}
     Caption Properties: {caption_properties}
+    Caption Mode: {caption_mode} ({', '.join([SUBTITLE_DEFAULT_LANGUAGE] + list(caption_variants or {}))})
     Display Duration per Image: {display_duration_per_image} seconds
+    Image Cuts: {image_cuts}
     Audio Track Type: {track_type}
     Audio Track Title: {track_info['title']}
     Audio Track Link: {track_info['link']}
     Audio Track Length: {track_info['length']} seconds
     Audio File: {summary_data['audio_file']}
+    Audio Normalization: {audio_normalization}
+    Audio Fit: {audio_fit}
+    Audio Mux: {audio_path['description'] if audio_path else 'n/a'}
     Output Filename: {summary_data['output_file']}
+    Output Container: {output_container}{' (streamed to the output sink)' if output_sink is not None else ''}
     Estimated cost of all OpenAI calls: ${estimated_cost:.2f}
     """
 
     print(summary.strip())
 
-    cleanup(captioned_images_directory, audio_file)
+    cleanup(frame_stage['directory'] if frame_stage else None, audio_file)
+
+    metrics.update({
+        'elapsed_time': round(time.time() - start_time, 3),
+        'cpu_seconds': round(mp4_maker_history.get_cpu_seconds() - cpu_start, 3),
+        'number_of_images': number_of_images,
+        'video_length': total_video_length,
+        'outputs': len(published_paths),
+        'audio_copied': bool(audio_path and audio_path['copy']),
+    })
+    # Every finished run feeds the render time predictions
+    mp4_maker_history.record_run(mp4_maker_history.get_job_features(
+        number_of_images=number_of_images,
+        video_width=video_width,
+        video_height=video_height,
+        display_duration_per_image=display_duration_per_image,
+        renditions=None if preview else renditions,  # Previews are matched by their flag, like the jobs they are predicted for
+        caption_mode=caption_mode,
+        caption_variants=caption_variants,
+        preview=preview,
+        beat_sync=beat_sync,
+        normalize_audio=normalize_audio,
+        audio_source=soundtrack['audio_source'],
+    ), metrics, cache_hits={
+        'audio': soundtrack['audio_source'] == 'cache',
+        'loudness': soundtrack['loudness_cached'],
+        'beats': beats_cached,
+    })
+    return published_paths
 
 if __name__ == '__main__':
     print("This script is being run directly. Please use feeder.py to provide input captions.")
\ No newline at end of file
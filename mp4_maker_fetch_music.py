@@ -1,5 +1,6 @@
-import subprocess
+import math
 from mutagen.mp3 import MP3
+from mp4_maker_ffmpeg_runner import run_ffmpeg, get_media_duration
 import mp4_maker_random_rfm_selector 
 import os
 
@@ -9,22 +10,54 @@ MIN_LENGTH = EXACT_LENGTH  # Ensuring the minimum length is at least the exact l
 
 # ===END OF SAMPLE CONFIG VALUES===
 
-def trim_audio_to_exact_length(filename, target_length):
+# ===AUDIO FIT OPTIONS===
+# How a track that is shorter than the video gets extended, per track_type.
+# 'mode' is 'crossfade' (loop with overlapping fades), 'loop' (hard loop) or 'none' (fetch a longer track instead).
+# 'min_length' is the shortest track accepted for extending before going back to the network.
+AUDIO_FIT_OPTIONS = {
+    'default': {'mode': 'crossfade', 'crossfade_duration': 2.0, 'min_length': 30},
+    'phonk': {'mode': 'loop', 'crossfade_duration': 0, 'min_length': 15},
+    'magic': {'mode': 'crossfade', 'crossfade_duration': 3.0, 'min_length': 30},
+}
+# ===AUDIO FIT OPTIONS===
+
+def get_audio_fit_options(track_type=None):
+    fit_options = dict(AUDIO_FIT_OPTIONS['default'])
+    fit_options.update(AUDIO_FIT_OPTIONS.get(track_type, {}))
+    return fit_options
+
+def get_min_acceptable_length(target_length, track_type=None):
+    # Shortest track worth keeping for this video, the mux stage loops it up to the full length
+    fit_options = get_audio_fit_options(track_type)
+    if fit_options['mode'] == 'none':
+        return None
+    return min(target_length, fit_options['min_length'])
+
+def get_loop_count(audio_length, target_length, crossfade_duration=0):
+    # Every extra copy adds the track length minus the part that overlaps with the previous copy
+    if audio_length >= target_length:
+        return 1
+    added_per_copy = audio_length - crossfade_duration
+    return 1 + math.ceil((target_length - audio_length) / added_per_copy)
+
+def get_audio_length(filename):
     file_extension = os.path.splitext(filename)[1].lower()
-    
+
     if file_extension == ".mp3":
         # If the file is MP3, we use Mutagen to check its length
         audio = MP3(filename)
-        audio_length = int(audio.info.length)
+        return int(audio.info.length)
     elif file_extension == ".mp4":
         # If the file is MP4, we use ffprobe to check its length
-        result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
-                                 "format=duration", "-of",
-                                 "default=noprint_wrappers=1:nokey=1", filename],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        audio_length = float(result.stdout)
+        return get_media_duration(filename)
     else:
         print(f"Unsupported file format: {file_extension}")
+        return None
+
+def trim_audio_to_exact_length(filename, target_length, allow_shorter=False):
+    file_extension = os.path.splitext(filename)[1].lower()
+    audio_length = get_audio_length(filename)
+    if audio_length is None:
         return False
 
     if audio_length == target_length:
@@ -32,18 +65,18 @@ def trim_audio_to_exact_length(filename, target_length):
     elif audio_length > target_length:
         # Trim the audio file to the exact length
         trimmed_filename = f"{os.path.splitext(filename)[0]}_trimmed{file_extension}"
-        subprocess.run([
+        run_ffmpeg([
             "ffmpeg", "-i", filename,
             "-ss", "0", "-to", str(target_length),
             "-c", "copy", trimmed_filename,
             "-y"  # Overwrite output files without asking
-        ])
+        ], total_duration=target_length)
         os.remove(filename)  # Remove the original file
         os.rename(trimmed_filename, filename)  # Rename trimmed file to original file name
         return True
     else:
-        # Audio is shorter than the target length; can't trim
-        return False
+        # Audio is shorter than the target length; can't trim, but the mux stage may loop it to length
+        return allow_shorter
 
 
 
@@ -0,0 +1,262 @@
+import re
+import json
+import subprocess
+import threading
+import time
+from collections import deque
+
+# ===FFMPEG RUNNER OPTIONS===
+FFMPEG_TIMEOUT = 60 * 60  # Hard deadline for a single ffmpeg run, in seconds
+FFMPEG_STALL_TIMEOUT = 120  # Kill ffmpeg when it reports no progress for this many seconds
+FFPROBE_TIMEOUT = 30  # Hard deadline for a single ffprobe run, in seconds
+WATCHDOG_INTERVAL = 0.5  # How often the watchdog checks the deadlines
+STDERR_TAIL_LINES = 50  # Lines of ffmpeg's stderr kept for error reports
+OUTPUT_SINK_CHUNK_SIZE = 256 * 1024  # Bytes handed to an output sink per write
+# ===FFMPEG RUNNER OPTIONS===
+
+
+class FFmpegRunError(Exception):
+    def __init__(self, message, command, reason, returncode=None, stderr_tail=''):
+        super().__init__(message)
+        self.command = command
+        self.reason = reason  # 'failed', 'timeout' or 'stalled'
+        self.returncode = returncode
+        self.stderr_tail = stderr_tail
+
+    def to_dict(self):
+        return {
+            'message': str(self),
+            'command': ' '.join(self.command),
+            'reason': self.reason,
+            'returncode': self.returncode,
+            'stderr_tail': self.stderr_tail,
+        }
+
+    def __str__(self):
+        return f"{super().__str__()} (reason: {self.reason}, return code: {self.returncode})\n{self.stderr_tail}"
+
+
+def parse_progress_value(value, convert):
+    # ffmpeg reports N/A (or nothing) until the first packet is muxed
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_progress_block(block, total_duration=None):
+    out_time_us = parse_progress_value(block.get('out_time_us', block.get('out_time_ms')), int)
+    progress = {
+        'frame': parse_progress_value(block.get('frame'), int) or 0,
+        'fps': parse_progress_value(block.get('fps'), float) or 0.0,
+        'out_time': (out_time_us or 0) / 1000000.0,
+        'speed': parse_progress_value(block.get('speed', '').strip().rstrip('x'), float),
+        'percent': None,
+        'done': block.get('progress') == 'end',
+    }
+    if total_duration:
+        progress['percent'] = min(100.0, 100.0 * progress['out_time'] / total_duration)
+    if progress['done']:
+        progress['percent'] = 100.0
+    return progress
+
+
+def make_progress_printer(label, step=10):
+    # Print every `step` percent instead of every progress block ffmpeg sends
+    state = {'next_percent': 0}
+
+    def on_progress(progress):
+        if not progress['done'] and (progress['percent'] is None or progress['percent'] < state['next_percent']):
+            return
+        speed = f"{progress['speed']:.2f}x" if progress['speed'] is not None else 'n/a'
+        print(f"{label}: {progress['percent']:.0f}% done, speed {speed}")
+        state['next_percent'] = progress['percent'] + step
+
+    return on_progress
+
+
+PROGRESS_LINE = re.compile(r'^\w+=')  # -progress lines are bare key=value pairs, log lines never start like that
+
+
+def run_ffmpeg(command, total_duration=None, on_progress=None, timeout=FFMPEG_TIMEOUT, stall_timeout=FFMPEG_STALL_TIMEOUT, output_sink=None):
+    """
+    Run ffmpeg under a watchdog, reporting progress as it goes.
+
+    :param command: Full ffmpeg command line, e.g. from ffmpeg.compile().
+    :param total_duration: Expected output duration in seconds, used to compute the percentage done.
+    :param on_progress: Optional callback called with a progress dict (percent, speed, out_time, frame, fps, done).
+    :param timeout: Hard deadline in seconds for the whole run.
+    :param stall_timeout: Seconds without any progress after which ffmpeg is considered hung.
+    :param output_sink: Optional file-like object (anything with write()) receiving what ffmpeg writes to pipe:1.
+                        Progress then moves to stderr, so the output stream stays clean.
+    :return: The last lines of ffmpeg's stderr.
+    :raises FFmpegRunError: When ffmpeg fails, misses its deadline or stalls.
+    """
+    progress_target = 'pipe:2' if output_sink is not None else 'pipe:1'
+    command = [command[0], '-hide_banner', '-nostats', '-progress', progress_target] + list(command[1:])
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    state = {'last_progress_time': time.time(), 'block': {}, 'sink_error': None}
+
+    def handle_progress_line(line):
+        key, _, value = line.strip().partition('=')
+        state['block'][key] = value
+        if key == 'progress':
+            state['last_progress_time'] = time.time()
+            block, state['block'] = state['block'], {}
+            if on_progress is not None:
+                # A broken callback must never stop the pipe from draining or the stall clock from ticking
+                try:
+                    on_progress(parse_progress_block(block, total_duration))
+                except Exception as e:
+                    print(f"Ignoring progress callback error: {type(e).__name__}: {e}")
+
+    def read_progress():
+        for line in process.stdout:
+            handle_progress_line(line.decode(errors='replace'))
+
+    def read_output():
+        # Hand the encoded stream on as it is produced, nothing is buffered beyond one chunk
+        while True:
+            chunk = process.stdout.read(OUTPUT_SINK_CHUNK_SIZE)
+            if not chunk:
+                break
+            try:
+                output_sink.write(chunk)
+            except Exception as e:
+                state['sink_error'] = e
+                process.kill()
+                break
+
+    def read_stderr():
+        for line in process.stderr:
+            line = line.decode(errors='replace')
+            if output_sink is not None and PROGRESS_LINE.match(line):
+                handle_progress_line(line)
+            else:
+                stderr_tail.append(line.rstrip())
+
+    readers = [threading.Thread(target=read_output if output_sink is not None else read_progress, daemon=True),
+               threading.Thread(target=read_stderr, daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    start_time = time.time()
+    reason = None
+    while process.poll() is None:
+        time.sleep(WATCHDOG_INTERVAL)
+        now = time.time()
+        if timeout and now - start_time > timeout:
+            reason = 'timeout'
+        elif stall_timeout and now - state['last_progress_time'] > stall_timeout:
+            reason = 'stalled'
+        if reason:
+            process.kill()
+            process.wait()
+            break
+
+    for reader in readers:
+        reader.join(timeout=5)
+
+    if reason == 'timeout':
+        raise FFmpegRunError(f"ffmpeg did not finish within {timeout} seconds", command, reason, process.returncode, '\n'.join(stderr_tail))
+    if reason == 'stalled':
+        raise FFmpegRunError(f"ffmpeg made no progress for {stall_timeout} seconds", command, reason, process.returncode, '\n'.join(stderr_tail))
+    if state['sink_error'] is not None:
+        raise FFmpegRunError(f"Writing ffmpeg's output failed: {state['sink_error']}", command, 'failed', process.returncode, '\n'.join(stderr_tail))
+    if process.returncode != 0:
+        raise FFmpegRunError("ffmpeg failed", command, 'failed', process.returncode, '\n'.join(stderr_tail))
+    return '\n'.join(stderr_tail)
+
+
+def iter_ffmpeg_output(command, chunk_size, timeout=FFMPEG_TIMEOUT):
+    """
+    Run ffmpeg writing raw data to stdout and yield it chunk by chunk, so callers never hold the whole output.
+
+    :param command: Full ffmpeg command line ending in an output to pipe:1.
+    :param chunk_size: Bytes per yielded chunk, only the last one may be shorter.
+    :param timeout: Hard deadline in seconds for the whole run.
+    :raises FFmpegRunError: When ffmpeg fails or misses its deadline.
+    """
+    command = [command[0], '-hide_banner', '-nostats'] + list(command[1:])
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    state = {'timed_out': False}
+
+    def read_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line.decode(errors='replace').rstrip())
+
+    def watchdog():
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            state['timed_out'] = True
+            process.kill()
+
+    readers = [threading.Thread(target=read_stderr, daemon=True), threading.Thread(target=watchdog, daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        # Also reached when the caller stops reading early
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        for reader in readers:
+            reader.join(timeout=5)
+
+    if state['timed_out']:
+        raise FFmpegRunError(f"ffmpeg did not finish within {timeout} seconds", command, 'timeout', process.returncode, '\n'.join(stderr_tail))
+    if process.returncode != 0:
+        raise FFmpegRunError("ffmpeg failed", command, 'failed', process.returncode, '\n'.join(stderr_tail))
+
+
+def run_ffprobe(command, timeout=FFPROBE_TIMEOUT):
+    """
+    Run ffprobe with a deadline.
+
+    :param command: Full ffprobe command line.
+    :return: ffprobe's stdout.
+    :raises FFmpegRunError: When ffprobe fails or misses its deadline.
+    """
+    try:
+        result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, errors='replace', timeout=timeout)
+    except subprocess.TimeoutExpired as e:
+        stderr = e.stderr.decode(errors='replace') if isinstance(e.stderr, bytes) else (e.stderr or '')
+        raise FFmpegRunError(f"ffprobe did not finish within {timeout} seconds", command, 'timeout', None, stderr)
+    if result.returncode != 0:
+        raise FFmpegRunError("ffprobe failed", command, 'failed', result.returncode, result.stderr.strip()[-2000:])
+    return result.stdout
+
+
+def get_media_duration(filename, timeout=FFPROBE_TIMEOUT):
+    output = run_ffprobe(["ffprobe", "-v", "error", "-show_entries",
+                          "format=duration", "-of",
+                          "default=noprint_wrappers=1:nokey=1", filename], timeout=timeout)
+    return float(output)
+
+
+def get_audio_stream_info(filename, timeout=FFPROBE_TIMEOUT):
+    """
+    Probe the first audio stream of a file.
+
+    :return: Dictionary with codec_name, sample_rate and channels, or None when the file has no audio stream.
+    """
+    output = run_ffprobe(["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries",
+                          "stream=codec_name,sample_rate,channels", "-of", "json", filename], timeout=timeout)
+    streams = json.loads(output or '{}').get('streams') or []
+    if not streams:
+        return None
+    return {
+        'codec_name': streams[0].get('codec_name'),
+        'sample_rate': int(streams[0].get('sample_rate') or 0),
+        'channels': int(streams[0].get('channels') or 0),
+    }
@@ -0,0 +1,86 @@
+# mp4_maker_frame_benchmark.py
+#
+# Measures how the frame enumeration and concat list stage scales with the number of frames.
+# Frames are tiny solid-color PNGs, the encode step is optional.
+
+import os
+import time
+import itertools
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import mp4_maker_engine
+from openai_stub_server import build_png
+
+# ===BENCHMARK OPTIONS===
+BENCHMARK_SIZES = [1000, 10000, 100000]  # Number of frames per run
+BENCHMARK_FRAME_PIXELS = 16  # Edge of every generated frame, keeps a 100k-frame directory small
+BENCHMARK_DISPLAY_DURATION = 0.04  # Seconds per frame for the optional encode, timelapse speed
+# ===BENCHMARK OPTIONS===
+
+
+def create_frames(directory, number_of_frames):
+    frame = build_png(BENCHMARK_FRAME_PIXELS, BENCHMARK_FRAME_PIXELS, (32, 96, 160))
+    for index in range(number_of_frames):
+        with open(os.path.join(directory, mp4_maker_engine.get_frame_filename(index)), 'wb') as f:
+            f.write(frame)
+
+
+def benchmark_frame_list(number_of_frames, encode=False, scratch_root=None):
+    """
+    Time the enumeration and concat list stage for one directory of frames.
+
+    :param number_of_frames: Number of frames to generate.
+    :param encode: Also encode the frames with a silent audio bed.
+    :return: Dictionary with the timings and the traced peak memory.
+    """
+    directory = tempfile.mkdtemp(prefix="mp4_maker_frame_benchmark_", dir=scratch_root)
+    try:
+        create_frames(directory, number_of_frames)
+        list_prefix = os.path.join(directory, "benchmark.mp4")
+
+        tracemalloc.start()
+        start = time.time()
+        image_files = mp4_maker_engine.get_image_files(directory)
+        enumerate_time = time.time() - start
+        start = time.time()
+        _, image_count = mp4_maker_engine.write_concat_list(image_files, itertools.repeat(BENCHMARK_DISPLAY_DURATION), f"{list_prefix}.ffconcat")
+        list_time = time.time() - start
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results = {
+            'frames': image_count,
+            'enumerate_time': enumerate_time,
+            'list_time': list_time,
+            'peak_bytes': peak_bytes,
+            'encode_time': None,
+        }
+
+        if encode:
+            video_length = image_count * BENCHMARK_DISPLAY_DURATION
+            start = time.time()
+            mp4_maker_engine.generate_video_from_images(directory, None, list_prefix, BENCHMARK_DISPLAY_DURATION,
+                                                        {'silence_duration': video_length}, total_duration=video_length,
+                                                        image_files=image_files)
+            results['encode_time'] = time.time() - start
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark frame enumeration and concat list generation.")
+    parser.add_argument("--sizes", type=int, nargs='+', default=BENCHMARK_SIZES)
+    parser.add_argument("--encode", action='store_true', help="Also encode every directory of frames with ffmpeg")
+    parser.add_argument("--scratch-root", default=None, help="Where the frames are generated, defaults to the temp directory")
+    args = parser.parse_args()
+
+    print("===FRAME BENCHMARK===")
+    for size in args.sizes:
+        results = benchmark_frame_list(size, encode=args.encode, scratch_root=args.scratch_root)
+        encode_time = f", encode {results['encode_time']:.2f}s" if results['encode_time'] is not None else ''
+        print(f"{results['frames']:>7} frames: enumerate {results['enumerate_time']:.3f}s, concat list {results['list_time']:.3f}s, "
+              f"peak {results['peak_bytes'] / (1024 * 1024):.1f} MiB traced{encode_time}")
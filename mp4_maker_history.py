@@ -0,0 +1,264 @@
+# mp4_maker_history.py
+#
+# Records what every finished render looked like and how long it took, and predicts the cost of new jobs from that.
+#
+#   python mp4_maker_history.py predict manifest.json --workers 4
+#   python mp4_maker_history.py recent --limit 20
+
+import os
+import json
+import time
+import heapq
+import socket
+import sqlite3
+import argparse
+import resource
+from contextlib import closing
+
+import numpy as np
+
+# ===HISTORY OPTIONS===
+HISTORY_ENABLED = os.getenv("MP4_MAKER_HISTORY_ENABLED", "1") == "1"
+# Next to the loudness and beat caches, so every worker pointed at the same shared cache root adds to one history
+HISTORY_FILE = os.getenv("MP4_MAKER_HISTORY_FILE", os.path.join(os.getenv('MP4_MAKER_AUDIO_DIR', 'audios'), 'mp4_maker_history.sqlite3'))
+HISTORY_WINDOW = 500  # Most recent runs used for a prediction, older ones describe hardware and settings we no longer run
+SQLITE_BUSY_TIMEOUT = 30  # Seconds to wait for another process' write lock
+# ===HISTORY OPTIONS===
+
+# Work that scales the render time: per-image work, pixels pushed through scale/caption/encode, seconds of audio, a fresh audio download
+MODEL_FEATURES = ('number_of_images', 'frame_megapixels', 'video_length', 'audio_download')
+
+
+def get_cpu_seconds():
+    # User and system time of this process plus every ffmpeg it has waited for.
+    # Process-wide, so concurrent renders in one process (load test, threads) share the count.
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def get_job_features(number_of_images, video_width, video_height, display_duration_per_image, renditions=None, caption_mode='burn',
+                     caption_variants=None, preview=False, beat_sync=False, normalize_audio=False, audio_source=None):
+    """
+    Describe a render by the characteristics its cost depends on.
+
+    :return: Dictionary of features, stored with every run and used to match a new job against the history.
+    """
+    output_sizes = [(rendition['width'], rendition['height']) for rendition in renditions] if renditions else [(video_width, video_height)]
+    variant_count = 1 + len(caption_variants or {}) if caption_mode == 'burn' else 1
+    output_pixels = sum(width * height for width, height in output_sizes) * variant_count
+    return {
+        'number_of_images': number_of_images,
+        'video_width': video_width,
+        'video_height': video_height,
+        'video_length': number_of_images * display_duration_per_image,
+        'outputs': len(output_sizes) * variant_count,
+        'frame_megapixels': number_of_images * output_pixels / 1e6,
+        'presets': ','.join(sorted({rendition.get('preset', 'medium') for rendition in renditions})) if renditions else 'medium',
+        'caption_mode': caption_mode,
+        'preview': bool(preview),
+        'beat_sync': bool(beat_sync),
+        'normalize_audio': bool(normalize_audio),
+        'audio_source': audio_source,
+    }
+
+
+def get_payload_features(payload):
+    # A job payload holds mp4_maker_engine.main keyword arguments, as queued for the render workers
+    number_of_images = payload.get('number_of_images') or len(payload.get('captions_list') or [])
+    return get_job_features(
+        number_of_images=number_of_images,
+        video_width=payload['video_width'],
+        video_height=payload['video_height'],
+        display_duration_per_image=payload['display_duration_per_image'],
+        renditions=None if payload.get('preview') else payload.get('renditions'),
+        caption_mode=payload.get('caption_mode', 'burn'),
+        caption_variants=payload.get('caption_variants'),
+        preview=payload.get('preview', False),
+        beat_sync=payload.get('beat_sync', False),
+        normalize_audio=payload.get('normalize_audio', False),
+        audio_source=payload.get('audio_source'),
+    )
+
+
+def connect(history_file=None):
+    history_file = history_file or HISTORY_FILE
+    history_directory = os.path.dirname(history_file)
+    if history_directory:
+        os.makedirs(history_directory, exist_ok=True)
+    connection = sqlite3.connect(history_file, timeout=SQLITE_BUSY_TIMEOUT)
+    connection.row_factory = sqlite3.Row
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recorded_at REAL NOT NULL,
+            host TEXT,
+            number_of_images INTEGER,
+            video_width INTEGER,
+            video_height INTEGER,
+            video_length REAL,
+            outputs INTEGER,
+            frame_megapixels REAL,
+            presets TEXT,
+            caption_mode TEXT,
+            preview INTEGER,
+            beat_sync INTEGER,
+            normalize_audio INTEGER,
+            audio_source TEXT,
+            audio_copied INTEGER,
+            cache_hits TEXT,
+            stages TEXT,
+            wall_time REAL,
+            cpu_seconds REAL
+        )
+    """)
+    return connection
+
+
+def record_run(features, metrics, cache_hits=None, history_file=None):
+    """
+    Store one finished render. Never raises, a full disk or a locked database must not fail a render.
+
+    :param features: Dictionary from get_job_features.
+    :param metrics: Metrics filled in by mp4_maker_engine.main (elapsed_time, cpu_seconds, stages...).
+    :param cache_hits: Dictionary telling which caches the run could use, e.g. {'audio': True, 'loudness': False}.
+    """
+    if not HISTORY_ENABLED:
+        return
+    history_file = history_file or HISTORY_FILE
+    row = dict(features)
+    row.update({
+        'recorded_at': time.time(),
+        'host': socket.gethostname(),
+        'audio_copied': bool(metrics.get('audio_copied')),
+        'cache_hits': json.dumps(cache_hits or {}),
+        'stages': json.dumps(metrics.get('stages', {})),
+        'wall_time': metrics.get('elapsed_time'),
+        'cpu_seconds': metrics.get('cpu_seconds'),
+    })
+    try:
+        with closing(connect(history_file)) as connection, connection:
+            connection.execute(
+                f"INSERT INTO runs ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+                list(row.values())
+            )
+    except (sqlite3.Error, OSError) as e:
+        print(f"Could not record the run in {history_file}: {e}")
+
+
+def load_runs(history_file=None, limit=HISTORY_WINDOW):
+    history_file = history_file or HISTORY_FILE
+    if not os.path.exists(history_file):
+        return []
+    with closing(connect(history_file)) as connection:
+        rows = connection.execute("SELECT * FROM runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_feature_vector(features, download_share):
+    audio_download = download_share if features.get('audio_source') is None else float(features['audio_source'] == 'download')
+    return [1.0, features['number_of_images'], features['frame_megapixels'], features['video_length'], audio_download]
+
+
+def predict_job(features, runs):
+    """
+    Predict the wall time and CPU seconds of one render from similar past runs.
+
+    Runs with the same preview flag and caption mode are preferred. With enough of them a least squares
+    fit over MODEL_FEATURES is used, otherwise the median cost per image of the closest runs is scaled up.
+
+    :param features: Dictionary from get_job_features or get_payload_features.
+    :param runs: Past runs from load_runs.
+    :return: Dictionary with wall_time, wall_time_high, cpu_seconds, method and samples, the times are None without history.
+    """
+    similar = [run for run in runs if bool(run['preview']) == features['preview'] and run['caption_mode'] == features['caption_mode']]
+    samples = similar or runs
+    if not samples:
+        return {'wall_time': None, 'wall_time_high': None, 'cpu_seconds': None, 'method': 'no history', 'samples': 0}
+
+    # A job that does not say where its audio comes from is assumed to download as often as past runs did
+    download_share = sum(run['audio_source'] == 'download' for run in samples) / float(len(samples))
+    job_vector = np.array(get_feature_vector(features, download_share))
+
+    if len(samples) >= len(MODEL_FEATURES) + 3:
+        matrix = np.array([get_feature_vector(run, download_share) for run in samples])
+        predictions = {}
+        for target in ('wall_time', 'cpu_seconds'):
+            values = np.array([run[target] or 0.0 for run in samples])
+            coefficients = np.linalg.lstsq(matrix, values, rcond=None)[0]
+            predictions[target] = max(0.0, float(job_vector @ coefficients))
+            if target == 'wall_time':
+                residuals = values - matrix @ coefficients
+                predictions['wall_time_high'] = predictions['wall_time'] + 1.28 * float(residuals.std())  # ~90th percentile
+        return dict(predictions, method='regression', samples=len(samples))
+
+    # Too few runs for a fit, scale the cost per image of the runs closest in size
+    closest = sorted(samples, key=lambda run: abs(run['frame_megapixels'] - features['frame_megapixels']))[:5]
+    wall_per_image = np.median([run['wall_time'] / max(1, run['number_of_images']) for run in closest])
+    cpu_per_image = np.median([(run['cpu_seconds'] or 0.0) / max(1, run['number_of_images']) for run in closest])
+    wall_time = float(wall_per_image * features['number_of_images'])
+    return {
+        'wall_time': wall_time,
+        'wall_time_high': wall_time * 1.5,
+        'cpu_seconds': float(cpu_per_image * features['number_of_images']),
+        'method': 'per-image ratio',
+        'samples': len(samples),
+    }
+
+
+def predict_manifest(payloads, workers=1, history_file=None):
+    """
+    Predict a batch of jobs, e.g. before queueing them for the render workers.
+
+    :param payloads: List of job payloads (mp4_maker_engine.main keyword arguments).
+    :param workers: Number of workers rendering the batch in parallel.
+    :return: Dictionary with the per-job predictions, the total CPU seconds and the expected batch wall time.
+    """
+    runs = load_runs(history_file)
+    jobs = [predict_job(get_payload_features(payload), runs) for payload in payloads]
+    if any(job['wall_time'] is None for job in jobs):
+        return {'jobs': jobs, 'cpu_seconds': None, 'wall_time': None, 'workers': workers}
+
+    # Longest job first onto the least busy worker, close to what a pulling worker fleet ends up doing
+    worker_loads = [0.0] * max(1, workers)
+    for wall_time in sorted((job['wall_time'] for job in jobs), reverse=True):
+        heapq.heapreplace(worker_loads, worker_loads[0] + wall_time)
+    return {
+        'jobs': jobs,
+        'cpu_seconds': sum(job['cpu_seconds'] for job in jobs),
+        'wall_time': max(worker_loads),
+        'workers': workers,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render history and time predictions.")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    predict_parser = subparsers.add_parser("predict", help="Predict a job file or a manifest holding a list of jobs")
+    predict_parser.add_argument("manifest")
+    predict_parser.add_argument("--workers", type=int, default=1)
+
+    recent_parser = subparsers.add_parser("recent", help="Show the most recent runs")
+    recent_parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "predict":
+        with open(args.manifest, 'r') as f:
+            manifest = json.load(f)
+        payloads = manifest if isinstance(manifest, list) else [manifest]
+        prediction = predict_manifest(payloads, args.workers, args.history)
+        for index, job in enumerate(prediction['jobs']):
+            if job['wall_time'] is None:
+                print(f"Job {index}: no history to predict from")
+            else:
+                print(f"Job {index}: {job['wall_time']:.1f}s wall (up to {job['wall_time_high']:.1f}s), "
+                      f"{job['cpu_seconds']:.1f} CPU seconds ({job['method']}, {job['samples']} runs)")
+        if prediction['wall_time'] is not None:
+            print(f"Batch: {prediction['wall_time']:.1f}s wall on {prediction['workers']} workers, {prediction['cpu_seconds']:.1f} CPU seconds")
+    else:
+        for run in load_runs(args.history, args.limit):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['recorded_at']))} {run['host']}: "
+                  f"{run['number_of_images']} images {run['video_width']}x{run['video_height']} x{run['outputs']}, "
+                  f"{run['wall_time']:.1f}s wall, {run['cpu_seconds']:.1f} CPU seconds, stages {run['stages']}")
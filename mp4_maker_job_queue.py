@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import closing
+
+# ===JOB QUEUE OPTIONS===
+# A SQLite file every worker can reach, e.g. on a shared disk. Fine for testing and small fleets,
+# network filesystems with unreliable locking need a real broker behind the same functions.
+JOB_QUEUE_FILE = os.getenv("MP4_MAKER_JOB_QUEUE", "mp4_maker_jobs.sqlite3")
+JOB_LEASE_SECONDS = 300  # A leased job goes back to the queue when its worker stops heartbeating for this long
+JOB_MAX_ATTEMPTS = 3  # Leases handed out per job before it is marked failed
+SQLITE_BUSY_TIMEOUT = 30  # Seconds to wait for another worker's write lock
+# ===JOB QUEUE OPTIONS===
+
+JOB_STATUSES = ('queued', 'leased', 'done', 'failed')
+
+
+def connect(queue_file=JOB_QUEUE_FILE):
+    queue_directory = os.path.dirname(queue_file)
+    if queue_directory:
+        os.makedirs(queue_directory, exist_ok=True)
+    # Autocommit mode, every change below runs inside an explicit BEGIN IMMEDIATE
+    connection = sqlite3.connect(queue_file, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            lease_owner TEXT,
+            lease_expires REAL,
+            result TEXT,
+            error TEXT,
+            metrics TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)")
+    return connection
+
+
+def run_in_transaction(queue_file, work):
+    # BEGIN IMMEDIATE takes the write lock up front, so two workers can never lease the same job
+    with closing(connect(queue_file)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+
+def enqueue_job(payload, queue_file=JOB_QUEUE_FILE, max_attempts=JOB_MAX_ATTEMPTS):
+    """
+    Add a render job to the queue.
+
+    :param payload: JSON-serializable keyword arguments for mp4_maker_engine.main.
+    :return: The id of the new job.
+    """
+    now = time.time()
+
+    def insert(connection):
+        cursor = connection.execute(
+            "INSERT INTO jobs (payload, max_attempts, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (json.dumps(payload), max_attempts, now, now)
+        )
+        return cursor.lastrowid
+
+    return run_in_transaction(queue_file, insert)
+
+
+def lease_job(worker_id, queue_file=JOB_QUEUE_FILE, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Hand the oldest available job to a worker.
+
+    Jobs whose lease expired count as available again, unless they already used up their attempts.
+
+    :return: Job dictionary with id, payload and attempts, or None when there is nothing to do.
+    """
+    def lease(connection):
+        now = time.time()
+        # Workers that died mid-render leave expired leases behind, give up on jobs that keep killing workers
+        connection.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, lease_owner = NULL, updated_at = ? "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= max_attempts",
+            ("Lease expired on the last attempt", now, now)
+        )
+        row = connection.execute(
+            "SELECT id, payload, attempts FROM jobs "
+            "WHERE status = 'queued' OR (status = 'leased' AND lease_expires < ?) "
+            "ORDER BY id LIMIT 1",
+            (now,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        connection.execute(
+            "UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (worker_id, now + lease_seconds, now, row['id'])
+        )
+        return {'id': row['id'], 'payload': json.loads(row['payload']), 'attempts': row['attempts'] + 1}
+
+    return run_in_transaction(queue_file, lease)
+
+
+def heartbeat(job_id, worker_id, queue_file=JOB_QUEUE_FILE, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Extend a lease.
+
+    :return: False when the worker no longer holds the lease, its result will not be accepted.
+    """
+    def extend(connection):
+        now = time.time()
+        cursor = connection.execute(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+            (now + lease_seconds, now, job_id, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    return run_in_transaction(queue_file, extend)
+
+
+def complete_job(job_id, worker_id, result, metrics=None, queue_file=JOB_QUEUE_FILE):
+    """
+    Store the result of a finished job.
+
+    :return: False when the lease was lost in the meantime and another worker owns the job.
+    """
+    def complete(connection):
+        cursor = connection.execute(
+            "UPDATE jobs SET status = 'done', result = ?, metrics = ?, error = NULL, lease_owner = NULL, updated_at = ? "
+            "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+            (json.dumps(result), json.dumps(metrics or {}), time.time(), job_id, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    return run_in_transaction(queue_file, complete)
+
+
+def fail_job(job_id, worker_id, error, metrics=None, retry=True, queue_file=JOB_QUEUE_FILE):
+    """
+    Record a failed attempt, the job goes back to the queue while it has attempts left.
+
+    :return: False when the lease was lost in the meantime and another worker owns the job.
+    """
+    def fail(connection):
+        cursor = connection.execute(
+            "UPDATE jobs SET status = CASE WHEN ? AND attempts < max_attempts THEN 'queued' ELSE 'failed' END, "
+            "error = ?, metrics = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? "
+            "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+            (1 if retry else 0, error, json.dumps(metrics or {}), time.time(), job_id, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    return run_in_transaction(queue_file, fail)
+
+
+def get_job(job_id, queue_file=JOB_QUEUE_FILE):
+    with closing(connect(queue_file)) as connection:
+        row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    for key in ('payload', 'result', 'metrics'):
+        if job[key] is not None:
+            job[key] = json.loads(job[key])
+    return job
+
+
+def get_job_counts(queue_file=JOB_QUEUE_FILE):
+    with closing(connect(queue_file)) as connection:
+        rows = connection.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+    counts = {status: 0 for status in JOB_STATUSES}
+    counts.update({row['status']: row['count'] for row in rows})
+    return counts
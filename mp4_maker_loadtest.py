@@ -0,0 +1,140 @@
+# mp4_maker_loadtest.py
+#
+# Drives mp4_maker_configs.main concurrently against openai_stub_server and reports throughput and tail latency.
+# Only the generation path is exercised, the video render is skipped.
+
+import os
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import openai_quota
+import openai_utils
+import openai_stub_server
+import mp4_maker_configs
+
+# ===LOAD TEST OPTIONS===
+LOADTEST_JOBS = 8  # Number of mp4_maker_configs.main runs
+LOADTEST_CONCURRENCY = 4  # How many of those runs at the same time
+LOADTEST_IMAGES_PER_MINUTE = 0  # Image quota during the test, 0 turns the quota governor off so the stub is what gets measured
+# ===LOAD TEST OPTIONS===
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percentile / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_load_test(jobs=LOADTEST_JOBS, concurrency=LOADTEST_CONCURRENCY, image_in_flight=mp4_maker_configs.IMAGE_MAX_IN_FLIGHT,
+                  images_per_minute=LOADTEST_IMAGES_PER_MINUTE, **stub_options):
+    """
+    Run the image generation path of several jobs at once against a local stub server.
+
+    :param jobs: Number of mp4_maker_configs.main runs.
+    :param concurrency: How many runs execute at the same time.
+    :param image_in_flight: Value for mp4_maker_configs.IMAGE_MAX_IN_FLIGHT during the test.
+    :param images_per_minute: Image quota during the test, 0 turns the quota governor off.
+    :param stub_options: Passed on to openai_stub_server.create_stub_server (latency, error rate, bursts...).
+    :return: Dictionary with the measured throughput and latency figures.
+    """
+    stub_server = openai_stub_server.create_stub_server(port=0, **stub_options)
+    threading.Thread(target=stub_server.serve_forever, daemon=True).start()
+    host, port = stub_server.server_address[:2]
+    openai_utils.set_api_base(f"http://{host}:{port}/v1")
+    openai_utils.CACHE_MODE = "off"  # Every request has to reach the stub
+    mp4_maker_configs.IMAGE_MAX_IN_FLIGHT = image_in_flight
+    openai_quota.QUOTA_ENABLED = images_per_minute > 0
+    if images_per_minute > 0:
+        openai_quota.IMAGES_PER_MINUTE = images_per_minute
+
+    image_latencies = []
+    job_latencies = []
+    lock = threading.Lock()
+    generate_image = mp4_maker_configs.generate_image
+
+    def timed_generate_image(*args, **kwargs):
+        start = time.time()
+        result = generate_image(*args, **kwargs)
+        with lock:
+            image_latencies.append(time.time() - start)
+        return result
+
+    def run_job(job_index, scratch_directory):
+        start = time.time()
+        generated = mp4_maker_configs.main(os.path.join(scratch_directory, f"job_{job_index:04d}"), render_video=False)
+        with lock:
+            job_latencies.append(time.time() - start)
+        return len(generated or [])
+
+    mp4_maker_configs.generate_image = timed_generate_image
+    try:
+        with tempfile.TemporaryDirectory(prefix="mp4_maker_loadtest_") as scratch_directory:
+            # A private quota state file so the test never shares buckets with real runs on this host
+            openai_quota.QUOTA_STATE_FILE = os.path.join(scratch_directory, "quota.json")
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                images_generated = sum(executor.map(lambda job_index: run_job(job_index, scratch_directory), range(jobs)))
+            wall_time = time.time() - start
+    finally:
+        mp4_maker_configs.generate_image = generate_image
+        stub_server.shutdown()
+
+    return {
+        'jobs': jobs,
+        'concurrency': concurrency,
+        'image_in_flight': image_in_flight,
+        'images_per_minute': images_per_minute,
+        'wall_time': wall_time,
+        'images_generated': images_generated,
+        'images_expected': jobs * len(mp4_maker_configs.GPT_IMAGE_DESCRIPTION),
+        'images_per_second': images_generated / wall_time if wall_time else 0.0,
+        'image_p50': get_percentile(image_latencies, 50),
+        'image_p95': get_percentile(image_latencies, 95),
+        'image_p99': get_percentile(image_latencies, 99),
+        'job_p50': get_percentile(job_latencies, 50),
+        'job_p99': get_percentile(job_latencies, 99),
+        'stub_requests': stub_server.stats['requests'],
+        'stub_status_counts': dict(stub_server.stats['status_counts']),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the image generation path against a local stub server.")
+    parser.add_argument("--jobs", type=int, default=LOADTEST_JOBS)
+    parser.add_argument("--concurrency", type=int, default=LOADTEST_CONCURRENCY)
+    parser.add_argument("--image-in-flight", type=int, default=mp4_maker_configs.IMAGE_MAX_IN_FLIGHT)
+    parser.add_argument("--image-latency", type=float, default=openai_stub_server.STUB_IMAGE_LATENCY)
+    parser.add_argument("--error-rate", type=float, default=openai_stub_server.STUB_ERROR_RATE)
+    parser.add_argument("--burst-every", type=int, default=openai_stub_server.STUB_BURST_EVERY)
+    parser.add_argument("--burst-length", type=int, default=openai_stub_server.STUB_BURST_LENGTH)
+    parser.add_argument("--images-per-minute", type=int, default=LOADTEST_IMAGES_PER_MINUTE, help="0 turns the quota governor off")
+    args = parser.parse_args()
+
+    results = run_load_test(
+        jobs=args.jobs,
+        concurrency=args.concurrency,
+        image_in_flight=args.image_in_flight,
+        images_per_minute=args.images_per_minute,
+        image_latency=args.image_latency,
+        error_rate=args.error_rate,
+        burst_every=args.burst_every,
+        burst_length=args.burst_length
+    )
+
+    summary = f"""
+    ===LOAD TEST SUMMARY===
+    Jobs: {results['jobs']} ({results['concurrency']} concurrent, {results['image_in_flight']} images in flight per job)
+    Image Quota (images/minute): {results['images_per_minute'] or 'off'}
+    Wall Time: {results['wall_time']:.2f} seconds
+    Images Generated: {results['images_generated']} of {results['images_expected']}
+    Throughput: {results['images_per_second']:.2f} images/second
+    Image Latency p50/p95/p99: {results['image_p50']:.2f} / {results['image_p95']:.2f} / {results['image_p99']:.2f} seconds
+    Job Latency p50/p99: {results['job_p50']:.2f} / {results['job_p99']:.2f} seconds
+    Stub Requests: {results['stub_requests']} {results['stub_status_counts']}
+    """
+    print(summary.strip())
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import mp4_maker_workspace
+from mp4_maker_ffmpeg_runner import run_ffmpeg, FFmpegRunError
+
+# ===LOUDNESS OPTIONS===
+LOUDNESS_TARGET_I = -16.0  # Integrated loudness target in LUFS (EBU R128)
+LOUDNESS_TARGET_TP = -1.5  # Maximum true peak in dBTP
+LOUDNESS_TARGET_LRA = 11.0  # Loudness range target in LU
+LOUDNESS_CACHE_FILE = os.path.join(os.getenv('MP4_MAKER_AUDIO_DIR', 'audios'), 'loudness_cache.json')  # Measured stats, keyed by content hash
+NORMALIZED_SAMPLE_RATE = 48000  # loudnorm upsamples to 192kHz internally, bring it back down for the mux
+# ===LOUDNESS OPTIONS===
+
+
+def get_file_content_hash(filename, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def measure_loudness(filename):
+    """
+    Run the loudnorm analysis pass over a whole track.
+
+    :param filename: Path to the audio file to analyze.
+    :return: Dictionary with the measured input_i, input_tp, input_lra and input_thresh values.
+    """
+    loudnorm_filter = f"loudnorm=I={LOUDNESS_TARGET_I}:TP={LOUDNESS_TARGET_TP}:LRA={LOUDNESS_TARGET_LRA}:print_format=json"
+    try:
+        stderr = run_ffmpeg([
+            "ffmpeg", "-i", filename,
+            "-af", loudnorm_filter,
+            "-f", "null", "-"
+        ])
+    except FFmpegRunError as e:
+        print(f"Loudness analysis failed for {filename}: {e}")
+        return None
+
+    # loudnorm prints its JSON block at the very end of stderr
+    json_start = stderr.rfind('{')
+    json_end = stderr.rfind('}')
+    if json_start == -1 or json_end < json_start:
+        print(f"Loudness analysis for {filename} did not produce any stats.")
+        return None
+
+    measured = json.loads(stderr[json_start:json_end + 1])
+    return {key: measured[key] for key in ('input_i', 'input_tp', 'input_lra', 'input_thresh')}
+
+
+def get_loudness_stats(filename, cache_file=None):
+    """
+    Return the measured loudness of a track, running the analysis pass only on a cache miss.
+
+    :param filename: Path to the audio file.
+    :param cache_file: JSON file holding previously measured stats keyed by content hash.
+    :return: Measured stats dictionary, or None if the analysis failed.
+    """
+    cache_file = cache_file or LOUDNESS_CACHE_FILE
+    content_hash = get_file_content_hash(filename)
+    cache = mp4_maker_workspace.load_json_cache(cache_file)
+
+    if content_hash in cache:
+        print(f"Using cached loudness stats for {os.path.basename(filename)}")
+        return dict(cache[content_hash], cached=True)
+
+    print(f"Measuring loudness of {os.path.basename(filename)}...")
+    stats = measure_loudness(filename)
+    if stats is None:
+        return None
+
+    # Re-read under the lock right before writing so entries added by other runs in the meantime are kept
+    with mp4_maker_workspace.file_lock(cache_file):
+        cache = mp4_maker_workspace.load_json_cache(cache_file)
+        cache[content_hash] = stats
+        mp4_maker_workspace.save_json_cache(cache, cache_file, indent=4)
+    return dict(stats, cached=False)
+
+
+def get_loudnorm_filter_options(stats):
+    # Single-pass loudnorm fed with the measured values behaves like the second pass of the two-pass recipe
+    return {
+        'I': LOUDNESS_TARGET_I,
+        'TP': LOUDNESS_TARGET_TP,
+        'LRA': LOUDNESS_TARGET_LRA,
+        'measured_I': stats['input_i'],
+        'measured_TP': stats['input_tp'],
+        'measured_LRA': stats['input_lra'],
+        'measured_thresh': stats['input_thresh'],
+        'linear': 'true',
+    }
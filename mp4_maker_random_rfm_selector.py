@@ -8,12 +8,14 @@ from mutagen.mp3 import MP3
 import feedparser
 from pytube import YouTube
 from pytube import Playlist
-import subprocess
 import multiprocessing
 from urllib.request import urlopen
 import urllib
 import logging
 import time
+import tempfile
+import mp4_maker_workspace
+from mp4_maker_ffmpeg_runner import get_media_duration
 
 
 
@@ -22,18 +24,16 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 
 
+# Shared download cache, safe to use from several runs at once. Point it at shared storage to share it between hosts.
+AUDIO_DIRECTORY = os.getenv("MP4_MAKER_AUDIO_DIR", "./audios")
+
 HEADERS = ({'User-Agent':\
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36\
             (KHTML, like Gecko) Chrome/103.0.5060.66 Safari/537.36',\
             'Accept-Language': 'en-US,en;q=0.9,zh-TW;q=0.8,zh-CN;q=0.7,zh;q=0.6,ja;q=0.5'})
 
 def get_length(filename):
-    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
-                             "format=duration", "-of",
-                             "default=noprint_wrappers=1:nokey=1", filename],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    return float(result.stdout)
+    return get_media_duration(filename)
 
 def load_soup(wikiurl):
     #table_class="wikitable sortable jquery-tablesorter"
@@ -305,9 +305,18 @@ def get_rndmfiftysounds_rfmp3_link():
     return("https://www.fiftysounds.com"+random.choice(mp3_links))
 
 
-def get_rndm_rfmp3(min_length_in_sec):
-    if not os.path.isdir('.//audios'):
-        os.makedirs('.//audios')
+def is_acceptable_length(audio_length, min_length_in_sec, min_acceptable_length=None):
+    # Tracks shorter than the video are still usable when the mux stage is allowed to loop them
+    if audio_length > min_length_in_sec:
+        return True
+    return min_acceptable_length is not None and audio_length >= min_acceptable_length
+
+def get_track_lock_path(file_path):
+    # One lock per cached track, whatever its extension; hold it while reading a track out of the cache
+    return os.path.splitext(file_path)[0]
+
+def get_rndm_rfmp3(min_length_in_sec, min_acceptable_length=None):
+    os.makedirs(AUDIO_DIRECTORY, exist_ok=True)
   
     too_short=1
     while (too_short):
@@ -345,21 +354,27 @@ def get_rndm_rfmp3(min_length_in_sec):
             else:
                 random_mp3_url_valid=1
         
-        mp3_file = './audios/'+random_mp3_url.split("/")[-1]
+        mp3_file = os.path.join(AUDIO_DIRECTORY, random_mp3_url.split("/")[-1])
         if ".mp3" not in mp3_file:
             mp3_file = mp3_file + ".mp3"
-        file_exists = exists(mp3_file)
-        if (file_exists==False):
-            response = requests.get(random_mp3_url)
-            open(mp3_file , "wb").write(response.content)
-        else:
-            pass
-        try:
-            if (MP3(mp3_file).info.length > min_length_in_sec):
-                too_short=0
-        except:
-            too_short=1
-            os.remove(mp3_file)
+        with mp4_maker_workspace.file_lock(get_track_lock_path(mp3_file)):
+            file_exists = exists(mp3_file)
+            if (file_exists==False):
+                response = requests.get(random_mp3_url)
+                # Write under a private name first so other runs never read a half-downloaded file
+                partial_file = f"{mp3_file}.{os.getpid()}.part"
+                with open(partial_file, "wb") as f:
+                    f.write(response.content)
+                os.replace(partial_file, mp3_file)
+            else:
+                pass
+            # Tracks too short for this video stay cached for shorter ones, only unreadable files are removed
+            try:
+                if is_acceptable_length(MP3(mp3_file).info.length, min_length_in_sec, min_acceptable_length):
+                    too_short=0
+            except:
+                too_short=1
+                os.remove(mp3_file)
     print("Source : "+ random_mp3_url)
     print("Save as "+mp3_file)
     print("Music length is "+str(MP3(mp3_file).info.length)+ " seconds")
@@ -382,17 +397,18 @@ def get_youtube_video_details(video_link):
     }
     return details
 
-def get_rndm_yt_rfm(min_length_in_sec, track_type=None):
+def get_rndm_yt_rfm(min_length_in_sec, track_type=None, min_acceptable_length=None):
     too_short = True
     custom_urls = {
         'magic': 'https://www.youtube.com/watch?v=dh01eSOn9_E',
         'phonk': 'https://www.youtube.com/watch?v=G2uGZ9Bt8JU'
     }
+    too_short_links = set()  # Cached tracks are never deleted, remember the ones that do not fit this video
     logging.info("Attempting to download YouTube audio...")
 
     while too_short:
         try:
-            if track_type and track_type in custom_urls:
+            if track_type and track_type in custom_urls and custom_urls[track_type] not in too_short_links:
                 video_link = custom_urls[track_type]
             else:
                 method = random.choice([1, 2])
@@ -430,37 +446,51 @@ def get_rndm_yt_rfm(min_length_in_sec, track_type=None):
 
 
 
-            # Check for an existing file with the expected filename
-            expected_filename = f"./audios/{video_link.split('watch?v=')[1]}.mp3"
-            file_exists = os.path.exists(expected_filename)
-
-            if file_exists:
-                audio_length = MP3(expected_filename).info.length
-                if audio_length > min_length_in_sec:
-                    logging.info(f"Using existing file: {expected_filename}")
-                    too_short = False
-                    track_details = {
-                        'title': 'Existing File',
-                        'link': video_link,
-                        'length': audio_length,
-                        'file_path': expected_filename
-                    }
-                    return track_details
-                else:
-                    logging.info(f"Existing file is too short, removing: {expected_filename}")
-                    os.remove(expected_filename)
-            
-            logging.info("Downloading audio...")
-            start_time = time.time()
-            out_filename = video.download(output_path="./audios/")
-            logging.info(f"Downloaded audio in {time.time() - start_time:.2f} seconds")
-
-            # Check the downloaded file's extension
-            file_extension = os.path.splitext(out_filename)[1].lower()
-            new_filename = "./audios/" + video_link.split("watch?v=")[1] + file_extension
-            
-            # Rename the file to keep the extension intact
-            os.rename(out_filename, new_filename)
+            video_id = video_link.split('watch?v=')[1]
+            os.makedirs(AUDIO_DIRECTORY, exist_ok=True)
+
+            # One run at a time checks and fills the cache entry for this video, the others wait and reuse it
+            with mp4_maker_workspace.file_lock(get_track_lock_path(os.path.join(AUDIO_DIRECTORY, video_id))):
+                # Check for an existing file with the expected filename
+                existing_filenames = [os.path.join(AUDIO_DIRECTORY, video_id + extension) for extension in ('.mp3', '.mp4')]
+                expected_filename = next((filename for filename in existing_filenames if os.path.exists(filename)), None)
+
+                if expected_filename:
+                    if expected_filename.endswith('.mp3'):
+                        audio_length = MP3(expected_filename).info.length
+                    else:
+                        audio_length = get_length(expected_filename)
+                    if is_acceptable_length(audio_length, min_length_in_sec, min_acceptable_length):
+                        logging.info(f"Using existing file: {expected_filename}")
+                        too_short = False
+                        track_details = {
+                            'title': 'Existing File',
+                            'link': video_link,
+                            'length': audio_length,
+                            'file_path': expected_filename,
+                            'cached': True
+                        }
+                        return track_details
+                    else:
+                        # Another run may be about to copy it, and it still fits shorter videos
+                        logging.info(f"Existing file is too short for this video, trying another source: {expected_filename}")
+                        too_short_links.add(video_link)
+                        continue
+
+                logging.info("Downloading audio...")
+                start_time = time.time()
+                # Download into a private directory and move it into the cache once it is complete
+                download_directory = tempfile.mkdtemp(dir=AUDIO_DIRECTORY)
+                out_filename = video.download(output_path=download_directory)
+                logging.info(f"Downloaded audio in {time.time() - start_time:.2f} seconds")
+
+                # Check the downloaded file's extension
+                file_extension = os.path.splitext(out_filename)[1].lower()
+                new_filename = os.path.join(AUDIO_DIRECTORY, video_id + file_extension)
+
+                # Rename the file to keep the extension intact
+                os.replace(out_filename, new_filename)
+                os.rmdir(download_directory)
 
             # Depending on the file extension, use the appropriate function to get the length
             if file_extension == '.mp3':
@@ -471,12 +501,12 @@ def get_rndm_yt_rfm(min_length_in_sec, track_type=None):
                 logging.error("Unsupported file format.")
                 return None
 
-            if audio_length > min_length_in_sec:
+            if is_acceptable_length(audio_length, min_length_in_sec, min_acceptable_length):
                 logging.info(f"Downloaded audio is suitable. It is {audio_length} seconds long.")
                 too_short = False
             else:
                 logging.info(f"Downloaded audio is too short. It is {audio_length} seconds long.")
-                os.remove(new_filename)
+                too_short_links.add(video_link)
                 logging.info("Retrying download with a different source...")
 
         except Exception as e:
@@ -489,6 +519,7 @@ def get_rndm_yt_rfm(min_length_in_sec, track_type=None):
         # Use the helper function to get video details.
         track_details = get_youtube_video_details(video_link)
         track_details['file_path'] = new_filename
+        track_details['cached'] = False
         
         return track_details
     else:
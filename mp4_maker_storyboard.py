@@ -0,0 +1,142 @@
+import json
+from openai_utils import chat_completion
+
+# ===STORYBOARD OPTIONS===
+STORYBOARD_MODEL = "gpt-3.5-turbo-1106"  # JSON mode needs gpt-3.5-turbo-1106 or newer
+STORYBOARD_TEMPERATURE = 0.7
+STORYBOARD_MAX_TOKENS = 2000  # Room for every scene description and caption in one response
+STORYBOARD_STREAM = True  # Hand each scene over as soon as it is complete instead of waiting for the last one
+CAPTION_MAX_CHARACTERS = 50
+# ===STORYBOARD OPTIONS===
+
+STORYBOARD_SYSTEM_PROMPT = """
+You write storyboards for short illustrated slideshow videos.
+Reply with a JSON object of the form {"scenes": [{"description": "...", "caption": "..."}]}.
+Each description is a single sentence telling an image model what the main character is doing in that scene.
+Each caption is a short line shown on screen over that scene, at most {caption_max_characters} characters.
+"""
+
+
+def build_storyboard_messages(character_description, storyline_description, number_of_scenes):
+    system_prompt = STORYBOARD_SYSTEM_PROMPT.strip().replace("{caption_max_characters}", str(CAPTION_MAX_CHARACTERS))
+    user_prompt = (
+        f"Main character:\n{character_description.strip()}\n\n"
+        f"Storyline:\n{storyline_description.strip()}\n\n"
+        f"Write exactly {number_of_scenes} scenes, in story order."
+    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def is_valid_scene(scene):
+    return (
+        isinstance(scene, dict)
+        and isinstance(scene.get("description"), str) and scene["description"].strip()
+        and isinstance(scene.get("caption"), str) and scene["caption"].strip()
+    )
+
+
+def make_scene_parser(on_scene):
+    """
+    Build an incremental parser that pulls scene objects out of the streamed JSON text.
+
+    :param on_scene: Callback called with (index, scene) as soon as a scene object is complete.
+    :return: A feed(text) function to call with every received piece of content.
+    """
+    state = {"buffer": [], "depth": 0, "in_string": False, "escaped": False, "scene_start": None, "scene_count": 0}
+
+    def feed(text):
+        buffer = state["buffer"]
+        for character in text:
+            buffer.append(character)
+
+            if state["in_string"]:
+                if state["escaped"]:
+                    state["escaped"] = False
+                elif character == "\\":
+                    state["escaped"] = True
+                elif character == '"':
+                    state["in_string"] = False
+                continue
+
+            if character == '"':
+                state["in_string"] = True
+            elif character in "{[":
+                # Scenes are the objects directly inside the top-level object's array
+                if character == "{" and state["depth"] == 2:
+                    state["scene_start"] = len(buffer) - 1
+                state["depth"] += 1
+            elif character in "}]":
+                state["depth"] -= 1
+                if character == "}" and state["depth"] == 2 and state["scene_start"] is not None:
+                    scene_text = "".join(buffer[state["scene_start"]:])
+                    state["scene_start"] = None
+                    try:
+                        scene = json.loads(scene_text)
+                    except ValueError:
+                        print(f"Skipping malformed scene: {scene_text}")
+                        continue
+                    if is_valid_scene(scene):
+                        on_scene(state["scene_count"], scene)
+                        state["scene_count"] += 1
+                    else:
+                        print(f"Skipping malformed scene: {scene}")
+
+        if state["scene_start"] is None:
+            # Nothing before the current position is needed any more
+            buffer.clear()
+
+    return feed
+
+
+def generate_storyboard(character_description, storyline_description, number_of_scenes, on_scene=None, stream=STORYBOARD_STREAM):
+    """
+    Generate every scene description and caption for a video in one JSON-mode chat request.
+
+    :param character_description: Description of the main character, as used in the image prompts.
+    :param storyline_description: What the story is about.
+    :param number_of_scenes: How many scenes, and therefore images, to generate.
+    :param on_scene: Optional callback called with (index, scene) as soon as each scene is available.
+    :param stream: Stream the response so early scenes are handed over before the later ones are written.
+    :return: List of scene dictionaries with 'description' and 'caption' keys, or None when the request failed
+        or did not return exactly number_of_scenes usable scenes.
+    """
+    scenes = []
+    extra_scenes = []
+
+    def collect_scene(index, scene):
+        # Every dispatched scene may cost an image generation, never hand out more than were asked for
+        if len(scenes) >= number_of_scenes:
+            extra_scenes.append(scene)
+            return
+        scenes.append(scene)
+        if on_scene is not None:
+            on_scene(index, scene)
+
+    feed = make_scene_parser(collect_scene)
+    response = chat_completion(
+        messages=build_storyboard_messages(character_description, storyline_description, number_of_scenes),
+        model=STORYBOARD_MODEL,
+        temperature=STORYBOARD_TEMPERATURE,
+        max_tokens=STORYBOARD_MAX_TOKENS,
+        stop=None,
+        stream=stream,
+        response_format={"type": "json_object"},
+        on_delta=feed if stream else None
+    )
+
+    if "error" in response:
+        print(f"Storyboard generation failed: {response['error']}")
+        return None
+
+    if not stream:
+        feed(response["choices"][0]["message"]["content"])
+
+    if extra_scenes:
+        print(f"Storyboard returned {len(extra_scenes)} scenes more than the {number_of_scenes} asked for, ignoring them.")
+    if len(scenes) != number_of_scenes:
+        print(f"Storyboard returned {len(scenes)} scenes instead of {number_of_scenes}.")
+        return None
+    return scenes
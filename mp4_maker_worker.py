@@ -0,0 +1,167 @@
+# mp4_maker_worker.py
+#
+# Render worker: pulls jobs from the shared job queue and runs mp4_maker_engine.main for each one.
+# Start one per machine (or several per machine) against the same queue file:
+#
+#   python mp4_maker_worker.py --queue /shared/mp4_maker_jobs.sqlite3 --shared-cache-root /shared/cache work
+#   python mp4_maker_worker.py --queue /shared/mp4_maker_jobs.sqlite3 enqueue job.json
+#   python mp4_maker_worker.py --queue /shared/mp4_maker_jobs.sqlite3 status
+
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import traceback
+
+import mp4_maker_job_queue
+
+# ===WORKER OPTIONS===
+WORKER_POLL_INTERVAL = 5  # Seconds between queue polls while there is nothing to do
+WORKER_HEARTBEAT_INTERVAL = mp4_maker_job_queue.JOB_LEASE_SECONDS / 5  # Several heartbeats fit in one lease
+# ===WORKER OPTIONS===
+
+
+def configure_shared_caches(shared_cache_root):
+    # Audio tracks, loudness/beat stats, run history, generated images and the OpenAI quota live under one shared root,
+    # every worker reads through it and fills it on a miss. The modules read their paths at import time, so set them directly.
+    import openai_quota
+    import openai_utils
+    import mp4_maker_beats
+    import mp4_maker_history
+    import mp4_maker_loudness
+    import mp4_maker_random_rfm_selector
+
+    audio_directory = os.path.join(shared_cache_root, "audios")
+    os.environ["MP4_MAKER_AUDIO_DIR"] = audio_directory
+    os.environ["OPENAI_CACHE_DIR"] = os.path.join(shared_cache_root, "openai")
+    os.environ["OPENAI_QUOTA_STATE_FILE"] = os.path.join(shared_cache_root, "openai_quota.json")
+    os.environ["MP4_MAKER_HISTORY_FILE"] = os.path.join(audio_directory, "mp4_maker_history.sqlite3")
+
+    mp4_maker_random_rfm_selector.AUDIO_DIRECTORY = audio_directory
+    mp4_maker_loudness.LOUDNESS_CACHE_FILE = os.path.join(audio_directory, "loudness_cache.json")
+    mp4_maker_beats.BEAT_CACHE_FILE = os.path.join(audio_directory, "beat_cache.json")
+    mp4_maker_history.HISTORY_FILE = os.environ["MP4_MAKER_HISTORY_FILE"]
+    openai_utils.CACHE_DIRECTORY = os.environ["OPENAI_CACHE_DIR"]
+    openai_quota.QUOTA_STATE_FILE = os.environ["OPENAI_QUOTA_STATE_FILE"]
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def start_heartbeat(job_id, worker_id, queue_file):
+    # Keeps the lease alive while the render runs, and notices when another worker took the job over
+    state = {'stop': threading.Event(), 'lease_lost': False}
+
+    def beat():
+        while not state['stop'].wait(WORKER_HEARTBEAT_INTERVAL):
+            try:
+                if not mp4_maker_job_queue.heartbeat(job_id, worker_id, queue_file):
+                    print(f"Lost the lease on job {job_id}, its result will be discarded")
+                    state['lease_lost'] = True
+                    return
+            except Exception as e:
+                # A missed heartbeat is not fatal, the lease is several intervals long
+                print(f"Heartbeat for job {job_id} failed: {e}")
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    state['thread'] = thread
+    return state
+
+
+def run_job(job):
+    # Imported here so the queue commands never need ffmpeg-python and the scrapers installed
+    import mp4_maker_engine
+
+    metrics = {}
+    published_paths = mp4_maker_engine.main(metrics=metrics, **job['payload'])
+    return {'published_paths': published_paths or []}, metrics
+
+
+def work_one_job(worker_id, queue_file=mp4_maker_job_queue.JOB_QUEUE_FILE):
+    """
+    Lease one job, render it and report the outcome back to the queue.
+
+    :return: The leased job, or None when the queue had nothing to hand out.
+    """
+    job = mp4_maker_job_queue.lease_job(worker_id, queue_file)
+    if job is None:
+        return None
+
+    print(f"Worker {worker_id} leased job {job['id']} (attempt {job['attempts']})")
+    heartbeat_state = start_heartbeat(job['id'], worker_id, queue_file)
+    start_time = time.time()
+    try:
+        result, metrics = run_job(job)
+    except (Exception, SystemExit) as e:
+        # The engine still exits on some bad inputs, that must not take the whole worker down
+        metrics = {'elapsed_time': round(time.time() - start_time, 3), 'worker_id': worker_id}
+        error = f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+        print(f"Job {job['id']} failed: {type(e).__name__}: {e}")
+        mp4_maker_job_queue.fail_job(job['id'], worker_id, error, metrics, queue_file=queue_file)
+        return job
+    finally:
+        heartbeat_state['stop'].set()
+        heartbeat_state['thread'].join()
+
+    metrics['worker_id'] = worker_id
+    if heartbeat_state['lease_lost'] or not mp4_maker_job_queue.complete_job(job['id'], worker_id, result, metrics, queue_file):
+        print(f"Job {job['id']} finished after its lease was lost, another worker owns it now")
+    else:
+        print(f"Job {job['id']} done in {metrics.get('elapsed_time', 0):.2f} seconds: {result['published_paths']}")
+    return job
+
+
+def run_worker(queue_file=mp4_maker_job_queue.JOB_QUEUE_FILE, worker_id=None, max_jobs=None, exit_when_idle=False):
+    """
+    Keep working jobs off the queue.
+
+    :param max_jobs: Stop after this many jobs, None keeps going.
+    :param exit_when_idle: Stop as soon as the queue has nothing to hand out instead of polling.
+    :return: Number of jobs worked on.
+    """
+    worker_id = worker_id or get_worker_id()
+    jobs_worked = 0
+    while max_jobs is None or jobs_worked < max_jobs:
+        job = work_one_job(worker_id, queue_file)
+        if job is not None:
+            jobs_worked += 1
+            continue
+        if exit_when_idle:
+            break
+        time.sleep(WORKER_POLL_INTERVAL)
+    return jobs_worked
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render worker for the shared mp4_maker job queue.")
+    parser.add_argument("--queue", default=mp4_maker_job_queue.JOB_QUEUE_FILE, help="SQLite job queue file shared by all workers")
+    parser.add_argument("--shared-cache-root", default=None, help="Directory shared by all workers for audio, analysis and image caches")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    work_parser = subparsers.add_parser("work", help="Render jobs from the queue")
+    work_parser.add_argument("--max-jobs", type=int, default=None)
+    work_parser.add_argument("--exit-when-idle", action="store_true")
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add jobs from JSON files holding mp4_maker_engine.main keyword arguments")
+    enqueue_parser.add_argument("job_files", nargs="+")
+    enqueue_parser.add_argument("--max-attempts", type=int, default=mp4_maker_job_queue.JOB_MAX_ATTEMPTS)
+
+    subparsers.add_parser("status", help="Show how many jobs are in each state")
+    args = parser.parse_args()
+
+    if args.command == "work":
+        if args.shared_cache_root:
+            configure_shared_caches(args.shared_cache_root)
+        jobs_worked = run_worker(args.queue, max_jobs=args.max_jobs, exit_when_idle=args.exit_when_idle)
+        print(f"Worked {jobs_worked} jobs")
+    elif args.command == "enqueue":
+        for job_file in args.job_files:
+            with open(job_file, 'r') as f:
+                job_id = mp4_maker_job_queue.enqueue_job(json.load(f), args.queue, args.max_attempts)
+            print(f"Queued {job_file} as job {job_id}")
+    else:
+        print(json.dumps(mp4_maker_job_queue.get_job_counts(args.queue), indent=4))
@@ -0,0 +1,181 @@
+import os
+import json
+import fcntl
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+# ===WORKSPACE OPTIONS===
+# Every run gets its own scratch directory under here, so concurrent renders never share intermediate files
+SCRATCH_ROOT = os.getenv("MP4_MAKER_SCRATCH_ROOT", tempfile.gettempdir())
+KEEP_WORKSPACES = os.getenv("MP4_MAKER_KEEP_WORKSPACES", "0") == "1"  # Leave scratch directories behind for debugging
+# ===WORKSPACE OPTIONS===
+
+# ===FRAME SCRATCH OPTIONS===
+FRAME_SCRATCH_ROOT = os.getenv("MP4_MAKER_FRAME_SCRATCH_ROOT")  # Where intermediate frames go, unset picks RAM when it fits
+RAM_SCRATCH_ROOT = "/dev/shm"
+FRAME_MEMORY_BUDGET = int(os.getenv("MP4_MAKER_FRAME_MEMORY_BUDGET", str(1024 * 1024 * 1024)))  # Bytes of frames kept in RAM before spilling to disk
+RAM_SCRATCH_HEADROOM = 256 * 1024 * 1024  # Always left free in RAM_SCRATCH_ROOT for everything else on the host
+# ===FRAME SCRATCH OPTIONS===
+
+
+def create_run_workspace(prefix='mp4_maker_run_', scratch_root=None):
+    scratch_root = scratch_root or SCRATCH_ROOT
+    os.makedirs(scratch_root, exist_ok=True)
+    workspace = tempfile.mkdtemp(prefix=prefix, dir=scratch_root)
+    print(f"Using run workspace {workspace}")
+    return workspace
+
+
+def remove_run_workspace(workspace):
+    if KEEP_WORKSPACES:
+        print(f"Keeping run workspace {workspace}")
+        return
+    shutil.rmtree(workspace, ignore_errors=True)
+
+
+@contextmanager
+def file_lock(path):
+    # Advisory lock shared by every process on the host, held on a sidecar file next to the resource
+    lock_directory = os.path.dirname(path)
+    if lock_directory:
+        os.makedirs(lock_directory, exist_ok=True)
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_json_cache(cache_file):
+    # Analysis caches shared by every run, a missing or damaged file only means everything is a miss
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable cache {cache_file}: {e}")
+        return {}
+
+
+def save_json_cache(cache, cache_file, indent=None):
+    cache_directory = os.path.dirname(cache_file)
+    if cache_directory:
+        os.makedirs(cache_directory, exist_ok=True)
+    # Write to a temporary file first so a crashed run never leaves a half-written cache behind
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(cache, f, indent=indent)
+    os.replace(temp_file, cache_file)
+
+
+def copy_to_workspace(path, workspace):
+    # Work on a private copy so trimming and cleanup never touch the shared cache
+    workspace_path = os.path.join(workspace, os.path.basename(path))
+    shutil.copyfile(path, workspace_path)
+    return workspace_path
+
+
+def publish_output(source_path, output_directory, filename=None):
+    """
+    Move a finished file into the output directory so readers only ever see it complete.
+
+    :param source_path: Finished file inside the run workspace.
+    :param output_directory: Directory the file is published to.
+    :param filename: Name in the output directory, defaults to the source file name.
+    :return: Path of the published file.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    destination_path = os.path.join(output_directory, filename or os.path.basename(source_path))
+
+    # os.replace is atomic within one filesystem; across filesystems, stage a hidden copy next to the destination first
+    staging_path = os.path.join(output_directory, f".{os.path.basename(destination_path)}.{os.getpid()}.part")
+    try:
+        os.replace(source_path, destination_path)
+    except OSError:
+        shutil.copyfile(source_path, staging_path)
+        os.replace(staging_path, destination_path)
+        os.remove(source_path)
+    return destination_path
+
+
+def get_free_bytes(path):
+    stats = os.statvfs(path)
+    return stats.f_bavail * stats.f_frsize
+
+
+def choose_frame_scratch_root(estimated_bytes):
+    # An explicit location always wins, otherwise use RAM when it can hold what we expect to keep there
+    if FRAME_SCRATCH_ROOT:
+        return FRAME_SCRATCH_ROOT, False
+    if os.path.isdir(RAM_SCRATCH_ROOT):
+        needed_bytes = min(estimated_bytes, FRAME_MEMORY_BUDGET) + RAM_SCRATCH_HEADROOM
+        if get_free_bytes(RAM_SCRATCH_ROOT) >= needed_bytes:
+            return RAM_SCRATCH_ROOT, True
+    return None, False
+
+
+def create_frame_stage(workspace, name, estimated_bytes):
+    """
+    Create the directory intermediate frames are written to.
+
+    :param workspace: The run workspace, used for frames when RAM is not available and for spilled frames.
+    :param name: Name of the frame directory.
+    :param estimated_bytes: Rough size of all frames together, used to decide whether RAM is large enough.
+    :return: Frame stage dictionary, pass it to get_frame_path/commit_frame and finally remove_frame_stage.
+    """
+    scratch_root, in_memory = choose_frame_scratch_root(estimated_bytes)
+    if scratch_root:
+        os.makedirs(scratch_root, exist_ok=True)
+        directory = tempfile.mkdtemp(prefix=f"mp4_maker_{name}_", dir=scratch_root)
+    else:
+        directory = os.path.join(workspace, name)
+        os.makedirs(directory, exist_ok=True)
+
+    return {
+        'directory': directory,
+        'spill_directory': os.path.join(workspace, f"{name}_spill"),
+        'in_memory': in_memory,
+        'owned_outside_workspace': scratch_root is not None,
+        'bytes_in_memory': 0,
+        'bytes_written': 0,
+        'bytes_spilled': 0,
+        'frames_spilled': 0,
+    }
+
+
+def get_frame_path(stage, filename):
+    # Once the RAM budget is used up, further frames go to local disk
+    if stage['in_memory'] and stage['bytes_in_memory'] >= FRAME_MEMORY_BUDGET:
+        os.makedirs(stage['spill_directory'], exist_ok=True)
+        return os.path.join(stage['spill_directory'], filename)
+    return os.path.join(stage['directory'], filename)
+
+
+def commit_frame(stage, frame_path):
+    frame_size = os.path.getsize(frame_path)
+    stage['bytes_written'] += frame_size
+
+    if os.path.dirname(frame_path) == stage['spill_directory']:
+        # A symlink keeps every frame reachable from the one directory the encoder reads from
+        os.symlink(os.path.abspath(frame_path), os.path.join(stage['directory'], os.path.basename(frame_path)))
+        stage['bytes_spilled'] += frame_size
+        stage['frames_spilled'] += 1
+    elif stage['in_memory']:
+        stage['bytes_in_memory'] += frame_size
+
+
+def describe_frame_stage(stage):
+    location = 'RAM' if stage['in_memory'] else 'disk'
+    description = f"{stage['directory']} ({location}), {stage['bytes_written'] / (1024 * 1024):.1f} MiB written"
+    if stage['frames_spilled']:
+        description += f", {stage['frames_spilled']} frames ({stage['bytes_spilled'] / (1024 * 1024):.1f} MiB) spilled to {stage['spill_directory']}"
+    return description
+
+
+def remove_frame_stage(stage):
+    # Frames inside the workspace go away with it, RAM-backed ones have to be removed on their own
+    if stage['owned_outside_workspace'] and not KEEP_WORKSPACES:
+        shutil.rmtree(stage['directory'], ignore_errors=True)
@@ -0,0 +1,125 @@
+# openai_quota.py
+
+import os
+import json
+import time
+import fcntl
+import tempfile
+
+# ===QUOTA OPTIONS===
+QUOTA_ENABLED = os.getenv("OPENAI_QUOTA_ENABLED", "1") == "1"
+# Every process on the host that points at the same state file shares the same buckets
+QUOTA_STATE_FILE = os.getenv("OPENAI_QUOTA_STATE_FILE", os.path.join(tempfile.gettempdir(), "mp4_maker_openai_quota.json"))
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))  # Account-wide request limit
+IMAGES_PER_MINUTE = int(os.getenv("OPENAI_IMAGES_PER_MINUTE", "5"))  # DALL-E 3 image limit for the account tier
+QUOTA_POLL_INTERVAL = 0.5  # Upper bound on how long a waiting process sleeps before checking the buckets again
+RATE_LIMIT_FALLBACK_PAUSE = 20  # Seconds every process pauses after a 429 without a usable Retry-After
+# ===QUOTA OPTIONS===
+
+
+def get_limits():
+    return {
+        "requests": REQUESTS_PER_MINUTE,
+        "images": IMAGES_PER_MINUTE,
+    }
+
+
+def _locked_state(update):
+    # The lock file is separate from the state file so the state can be replaced atomically
+    with open(f"{QUOTA_STATE_FILE}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            state = {}
+            if os.path.exists(QUOTA_STATE_FILE):
+                try:
+                    with open(QUOTA_STATE_FILE, "r") as f:
+                        state = json.load(f)
+                except ValueError:
+                    state = {}
+
+            result = update(state)
+
+            temp_file = f"{QUOTA_STATE_FILE}.{os.getpid()}.tmp"
+            with open(temp_file, "w") as f:
+                json.dump(state, f)
+            os.replace(temp_file, QUOTA_STATE_FILE)
+            return result
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _refill(state, now):
+    for bucket_name, limit in get_limits().items():
+        bucket = state.setdefault(bucket_name, {"tokens": limit, "updated": now})
+        elapsed = max(0.0, now - bucket["updated"])
+        bucket["tokens"] = min(limit, bucket["tokens"] + elapsed * limit / 60.0)
+        bucket["updated"] = now
+
+
+def try_acquire(requests=1, images=0):
+    """
+    Take tokens from the shared buckets if they are all available.
+
+    :param requests: Number of API requests about to be made.
+    :param images: Number of images those requests will generate.
+    :return: 0 if the tokens were taken, otherwise the number of seconds to wait before trying again.
+    """
+    # A single call larger than a whole bucket would never fit, let it through once the bucket is full
+    limits = get_limits()
+    costs = {"requests": min(requests, limits["requests"]), "images": min(images, limits["images"])}
+
+    def update(state):
+        now = time.time()
+        _refill(state, now)
+
+        blocked_for = state.get("blocked_until", 0) - now
+        if blocked_for > 0:
+            return blocked_for
+
+        waits = [
+            (cost - state[bucket_name]["tokens"]) * 60.0 / limits[bucket_name]
+            for bucket_name, cost in costs.items()
+            if cost > state[bucket_name]["tokens"]
+        ]
+        if waits:
+            return max(waits)
+
+        for bucket_name, cost in costs.items():
+            state[bucket_name]["tokens"] -= cost
+        return 0
+
+    return _locked_state(update)
+
+
+def acquire(requests=1, images=0):
+    # Queue until the host-wide budget allows the call instead of sending it and eating a 429
+    if not QUOTA_ENABLED:
+        return 0
+
+    waited = 0.0
+    while True:
+        wait = try_acquire(requests, images)
+        if wait <= 0:
+            if waited > 0:
+                print(f"Quota governor: waited {waited:.1f} seconds for {requests} request(s), {images} image(s)")
+            return waited
+        sleep_time = min(wait, QUOTA_POLL_INTERVAL)
+        time.sleep(sleep_time)
+        waited += sleep_time
+
+
+def report_rate_limited(retry_after=None):
+    # A 429 seen by one process pauses all of them, otherwise the others keep hammering the API
+    if not QUOTA_ENABLED:
+        return
+
+    try:
+        pause = float(retry_after)
+    except (TypeError, ValueError):
+        pause = RATE_LIMIT_FALLBACK_PAUSE
+
+    def update(state):
+        state["blocked_until"] = max(state.get("blocked_until", 0), time.time() + pause)
+
+    _locked_state(update)
+    print(f"Quota governor: rate limited, pausing all API calls for {pause:.1f} seconds")
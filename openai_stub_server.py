@@ -0,0 +1,221 @@
+# openai_stub_server.py
+#
+# Local stand-in for the OpenAI image and chat endpoints, for load testing without spending money.
+# Point openai_utils at it with OPENAI_API_BASE=http://127.0.0.1:8765/v1 or openai_utils.set_api_base().
+
+import re
+import json
+import time
+import zlib
+import base64
+import random
+import struct
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ===STUB OPTIONS===
+STUB_HOST = "127.0.0.1"
+STUB_PORT = 8765
+STUB_IMAGE_LATENCY = 2.0  # Seconds an image generation takes
+STUB_CHAT_LATENCY = 0.5  # Seconds a chat completion takes
+STUB_LATENCY_JITTER = 0.25  # Fraction of the latency added or removed at random
+STUB_ERROR_RATE = 0.0  # Share of requests answered with a 500
+STUB_BURST_EVERY = 0  # Every this many requests a burst of 429s starts, 0 disables bursts
+STUB_BURST_LENGTH = 5  # Requests answered with 429 per burst
+STUB_RETRY_AFTER = 1  # Retry-After header sent with every 429
+STUB_IMAGE_PIXELS = 256  # Edge of the square PNG returned, kept small so the stub is not the bottleneck
+STUB_SEED = 1234
+# ===STUB OPTIONS===
+
+
+def build_png(width, height, rgb):
+    # Minimal solid-color PNG, no imaging library needed
+    def chunk(chunk_type, data):
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+
+def get_deterministic_image(prompt, pixels=STUB_IMAGE_PIXELS):
+    # The same prompt always gets the same color, so cached and fresh results can be compared
+    digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+    return build_png(pixels, pixels, digest[:3])
+
+
+def build_storyboard_content(messages):
+    user_prompt = " ".join(message.get("content", "") for message in messages if message.get("role") == "user")
+    match = re.search(r"exactly (\d+) scenes", user_prompt)
+    number_of_scenes = int(match.group(1)) if match else 8
+    return json.dumps({
+        "scenes": [
+            {"description": f"The character does thing number {i + 1}", "caption": f"Scene {i + 1}..."}
+            for i in range(number_of_scenes)
+        ]
+    })
+
+
+def create_stub_server(host=STUB_HOST, port=STUB_PORT, image_latency=STUB_IMAGE_LATENCY, chat_latency=STUB_CHAT_LATENCY,
+                       error_rate=STUB_ERROR_RATE, burst_every=STUB_BURST_EVERY, burst_length=STUB_BURST_LENGTH, seed=STUB_SEED):
+    """
+    Build a threaded HTTP server that answers like the OpenAI image and chat endpoints.
+
+    :param port: Port to listen on, 0 picks a free one (read it back from server.server_address).
+    :param image_latency: Seconds each image generation takes.
+    :param chat_latency: Seconds each chat completion takes.
+    :param error_rate: Share of requests answered with a 500.
+    :param burst_every: Every this many requests a burst of 429s starts, 0 disables bursts.
+    :param burst_length: Number of requests answered with 429 in each burst.
+    :return: The server, not yet started. server.stats holds per-status request counts.
+    """
+    lock = threading.Lock()
+    rng = random.Random(seed)
+    images = {}
+    stats = {"requests": 0, "status_counts": {}}
+
+    def next_outcome():
+        with lock:
+            stats["requests"] += 1
+            request_number = stats["requests"]
+            if burst_every and (request_number - 1) % burst_every < burst_length and request_number > burst_length:
+                return 429, rng.uniform(-STUB_LATENCY_JITTER, STUB_LATENCY_JITTER)
+            if rng.random() < error_rate:
+                return 500, rng.uniform(-STUB_LATENCY_JITTER, STUB_LATENCY_JITTER)
+            return 200, rng.uniform(-STUB_LATENCY_JITTER, STUB_LATENCY_JITTER)
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass  # Keep the load test output readable
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+            with lock:
+                stats["status_counts"][status] = stats["status_counts"].get(status, 0) + 1
+
+        def do_GET(self):
+            image = images.get(self.path)
+            if image is None:
+                self.send_json(404, {"error": {"message": "Not found"}})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            status, jitter = next_outcome()
+
+            if self.path.endswith("/images/generations"):
+                latency = image_latency
+            elif self.path.endswith("/chat/completions"):
+                latency = chat_latency
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+                return
+
+            if status == 429:
+                self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}}, {"Retry-After": str(STUB_RETRY_AFTER)})
+                return
+
+            time.sleep(max(0.0, latency * (1 + jitter)))
+
+            if status == 500:
+                self.send_json(500, {"error": {"message": "The server had an error while processing your request."}})
+            elif self.path.endswith("/images/generations"):
+                self.handle_image(payload)
+            else:
+                self.handle_chat(payload)
+
+        def handle_image(self, payload):
+            image = get_deterministic_image(payload.get("prompt", ""))
+            data = []
+            for _ in range(payload.get("n", 1)):
+                if payload.get("response_format") == "b64_json":
+                    data.append({"b64_json": base64.b64encode(image).decode("ascii"), "revised_prompt": payload.get("prompt")})
+                else:
+                    image_path = f"/images/{hashlib.sha256(image).hexdigest()}.png"
+                    images[image_path] = image
+                    host, port = self.server.server_address[:2]
+                    data.append({"url": f"http://{host}:{port}{image_path}", "revised_prompt": payload.get("prompt")})
+            self.send_json(200, {"created": int(time.time()), "data": data})
+
+        def handle_chat(self, payload):
+            if payload.get("response_format", {}) and payload["response_format"].get("type") == "json_object":
+                content = build_storyboard_content(payload.get("messages", []))
+            else:
+                content = "Hello! This is a deterministic reply from the local stub server."
+
+            response_id = f"chatcmpl-stub{stats['requests']}"
+            if not payload.get("stream"):
+                self.send_json(200, {
+                    "id": response_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": payload.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(content.split()), "total_tokens": len(content.split())},
+                })
+                return
+
+            # Server-sent events, a few characters per event like the real API
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for start in range(0, len(content), 8):
+                chunk = {
+                    "id": response_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": payload.get("model"),
+                    "choices": [{"index": 0, "delta": {"content": content[start:start + 8]}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            final_chunk = {"id": response_id, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            self.wfile.write(f"data: {json.dumps(final_chunk)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+            self.close_connection = True
+            with lock:
+                stats["status_counts"][200] = stats["status_counts"].get(200, 0) + 1
+
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.stats = stats
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stand-in server.")
+    parser.add_argument("--host", default=STUB_HOST)
+    parser.add_argument("--port", type=int, default=STUB_PORT)
+    parser.add_argument("--image-latency", type=float, default=STUB_IMAGE_LATENCY)
+    parser.add_argument("--chat-latency", type=float, default=STUB_CHAT_LATENCY)
+    parser.add_argument("--error-rate", type=float, default=STUB_ERROR_RATE)
+    parser.add_argument("--burst-every", type=int, default=STUB_BURST_EVERY)
+    parser.add_argument("--burst-length", type=int, default=STUB_BURST_LENGTH)
+    args = parser.parse_args()
+
+    stub_server = create_stub_server(args.host, args.port, args.image_latency, args.chat_latency,
+                                     args.error_rate, args.burst_every, args.burst_length)
+    print(f"Stub server listening on http://{args.host}:{args.port}/v1")
+    try:
+        stub_server.serve_forever()
+    except KeyboardInterrupt:
+        stub_server.shutdown()
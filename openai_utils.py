@@ -2,16 +2,28 @@
 
 import os
 import json
+import time
+import random
+import base64
+import hashlib
 import requests
 from dotenv import load_dotenv
+import openai_quota
 
 # Load OpenAI key from the .env file
 load_dotenv()
 openai_api_key = os.getenv("2023nov17_OPENAI_KEY")
 
-# Define the endpoints
-dalle_endpoint = "https://api.openai.com/v1/images/generations"
-chat_endpoint = "https://api.openai.com/v1/chat/completions"
+# Define the endpoints, OPENAI_API_BASE points them at any OpenAI-compatible server (e.g. openai_stub_server.py)
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+dalle_endpoint = f"{OPENAI_API_BASE}/images/generations"
+chat_endpoint = f"{OPENAI_API_BASE}/chat/completions"
+
+
+def set_api_base(api_base):
+    global dalle_endpoint, chat_endpoint
+    dalle_endpoint = f"{api_base.rstrip('/')}/images/generations"
+    chat_endpoint = f"{api_base.rstrip('/')}/chat/completions"
 
 # ===IMAGE OPTIONS===
 IMAGE_TO_CREATE = "A futuristic city skyline at sunset"
@@ -22,8 +34,14 @@ RESPONSE_FORMAT = "url"  # Must be 'url' or 'b64_json'
 IMAGE_SIZE = "1024x1024"  # For dall-e-3, options are '1024x1024', '1792x1024', '1024x1792'
 IMAGE_STYLE = "vivid"  # Can be 'vivid' or 'natural' for dall-e-3. 'vivid' is hyper-real, 'natural' is less so.
 USER_ID = "unique_user_identifier"  # Optional, a unique identifier for your end-user.
+B64_DECODE_CHUNK_SIZE = 4 * 256 * 1024  # Characters of base64 decoded per write, must be a multiple of 4
 # ===IMAGE OPTIONS===
 
+# ===RATE LIMIT OPTIONS===
+RATE_LIMIT_MAX_RETRIES = 5  # Times a 429 is queued again before it is handed back to the caller
+RATE_LIMIT_RETRY_BASE_DELAY = 2  # Seconds, doubled on every retry, only used without the quota governor and without Retry-After
+# ===RATE LIMIT OPTIONS===
+
 # ===CHAT OPTIONS===
 CHAT_MODEL = "gpt-3.5-turbo"
 CHAT_TEMPERATURE = 0.5
@@ -41,6 +59,15 @@ CHAT_LOGIT_BIAS = None  # Modify the likelihood of specified tokens appearing in
 CHAT_RESPONSE_FORMAT = None  # An object specifying the format that the model must output.
 # ===CHAT OPTIONS===
 
+# ===CACHE OPTIONS===
+CACHE_MODE = os.getenv("OPENAI_CACHE_MODE", "off")  # 'off', 'readwrite', or 'cache_only' to fail fast on a miss
+CACHE_DIRECTORY = os.getenv("OPENAI_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mp4_maker_openai"))
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60  # Entries older than this are treated as a miss and removed
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Least recently used entries are evicted above this size
+# Payload fields that do not change the result and must not split the cache, a streamed response is stored assembled
+CACHE_IGNORED_FIELDS = ("user", "response_format", "stream")
+# ===CACHE OPTIONS===
+
 # ===COST OPTIONS===
 # OpenAI's pricing (as of the date provided in your example)
 DALLE_PRICE_PER_IMAGE = 0.040  # Price per image for DALL·E 3 at standard quality and resolution
@@ -84,6 +111,176 @@ def summarize_and_estimate_cost(summary_data):
     print(summary.strip())
 
 
+def build_error_response(error):
+    # Keep the HTTP status and Retry-After hint so callers can decide whether to retry
+    error_response = {"error": str(error)}
+    response = getattr(error, "response", None)
+    if response is not None:
+        error_response["status_code"] = response.status_code
+        error_response["retry_after"] = response.headers.get("Retry-After")
+    return error_response
+
+
+def get_rate_limit_delay(retry_after, attempt):
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        # Missing or in the HTTP-date form, fall back to our own backoff
+        return RATE_LIMIT_RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, 1)
+
+
+def post_with_quota(endpoint, headers, payload, images=0, stream=False, max_rate_limit_retries=None):
+    # Wait for the shared quota before every attempt and queue again on a 429 instead of failing
+    max_rate_limit_retries = RATE_LIMIT_MAX_RETRIES if max_rate_limit_retries is None else max_rate_limit_retries
+    for attempt in range(max_rate_limit_retries + 1):
+        openai_quota.acquire(requests=1, images=images)
+        response = requests.post(endpoint, headers=headers, json=payload, timeout=60, stream=stream)
+        if response.status_code != 429 or attempt == max_rate_limit_retries:
+            return response
+        retry_after = response.headers.get("Retry-After")
+        if openai_quota.QUOTA_ENABLED:
+            # The governor pauses every process on the host, the next acquire() waits it out
+            openai_quota.report_rate_limited(retry_after)
+        else:
+            delay = get_rate_limit_delay(retry_after, attempt)
+            print(f"Rate limited, retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+
+
+def summarize_image_response(response_json):
+    summary = []
+    for i, image_data in enumerate(response_json.get("data", [])):
+        b64_length = len(image_data.get("b64_json") or "")
+        summary.append(f"image {i}: {b64_length * 3 // 4 / 1024:.0f} KiB (b64_json)")
+    return "\n".join(summary) or "no image data"
+
+
+def save_b64_image(b64_data, dest_path, chunk_size=B64_DECODE_CHUNK_SIZE):
+    """
+    Decode a base64 image straight to disk, one chunk at a time.
+
+    :param b64_data: The b64_json string from an image response.
+    :param dest_path: Path of the image file to write.
+    :param chunk_size: Number of base64 characters decoded per write.
+    :return: Number of bytes written.
+    """
+    bytes_written = 0
+    temp_path = f"{dest_path}.part"
+    with open(temp_path, "wb") as f:
+        for start in range(0, len(b64_data), chunk_size):
+            bytes_written += f.write(base64.b64decode(b64_data[start:start + chunk_size]))
+    os.replace(temp_path, dest_path)
+    return bytes_written
+
+
+def get_cache_key(kind, payload):
+    normalized_payload = {key: value for key, value in payload.items() if key not in CACHE_IGNORED_FIELDS and value is not None}
+    if isinstance(normalized_payload.get("prompt"), str):
+        normalized_payload["prompt"] = " ".join(normalized_payload["prompt"].split())
+    if kind == "chat" and payload.get("response_format") is not None:
+        # JSON mode does change what the model returns
+        normalized_payload["response_format"] = payload["response_format"]
+    serialized = json.dumps({"kind": kind, "payload": normalized_payload}, sort_keys=True)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def get_cache_entry_paths(cache_key):
+    return [os.path.join(CACHE_DIRECTORY, name) for name in os.listdir(CACHE_DIRECTORY) if name.startswith(cache_key)]
+
+
+def read_cache(cache_key):
+    response_path = os.path.join(CACHE_DIRECTORY, f"{cache_key}.json")
+    if not os.path.exists(response_path):
+        return None
+
+    if time.time() - os.path.getmtime(response_path) > CACHE_TTL_SECONDS:
+        for path in get_cache_entry_paths(cache_key):
+            os.remove(path)
+        return None
+
+    with open(response_path, "r") as f:
+        cached_response = json.load(f)
+
+    # An image evicted on its own makes the whole entry useless
+    if any(not os.path.exists(image_data["cached_path"]) for image_data in cached_response.get("data", []) if "cached_path" in image_data):
+        return None
+
+    # Bump access times so size-based eviction drops the least recently used entries first
+    for path in get_cache_entry_paths(cache_key):
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+    cached_response["cached"] = True
+    return cached_response
+
+
+def write_cache(cache_key, response_json):
+    temp_path = os.path.join(CACHE_DIRECTORY, f"{cache_key}.json.{os.getpid()}.tmp")
+    with open(temp_path, "w") as f:
+        json.dump(response_json, f)
+    os.replace(temp_path, os.path.join(CACHE_DIRECTORY, f"{cache_key}.json"))
+    prune_cache()
+
+
+def cache_image_response(cache_key, response_json):
+    # Store the image bytes next to the response so a hit never depends on an expired URL
+    for i, image_data in enumerate(response_json.get("data", [])):
+        cached_path = os.path.join(CACHE_DIRECTORY, f"{cache_key}_{i}.png")
+        if "b64_json" in image_data:
+            save_b64_image(image_data.pop("b64_json"), cached_path)
+        elif "url" in image_data:
+            image_content = requests.get(image_data["url"], timeout=60)
+            image_content.raise_for_status()
+            with open(f"{cached_path}.part", "wb") as f:
+                f.write(image_content.content)
+            os.replace(f"{cached_path}.part", cached_path)
+        image_data["cached_path"] = cached_path
+    write_cache(cache_key, response_json)
+    return response_json
+
+
+def prune_cache():
+    entries = []
+    for entry in os.scandir(CACHE_DIRECTORY):
+        if not entry.is_file() or entry.name.endswith(".tmp") or entry.name.endswith(".part"):
+            continue
+        stat = entry.stat()
+        if time.time() - stat.st_mtime > CACHE_TTL_SECONDS:
+            os.remove(entry.path)
+        else:
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Another run pruned it first
+        total_bytes -= size
+
+
+def lookup_cache(kind, payload):
+    """
+    Look a request up in the on-disk cache.
+
+    :param kind: 'image' or 'chat'.
+    :param payload: The request payload that would be sent to the API.
+    :return: (cache_key, cached response or None). cache_key is None when caching is off.
+    """
+    if CACHE_MODE == "off":
+        return None, None
+
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    cache_key = get_cache_key(kind, payload)
+    cached_response = read_cache(cache_key)
+    if cached_response is not None:
+        print(f"Cache hit for {kind} request {cache_key[:12]}")
+    elif CACHE_MODE == "cache_only":
+        print(f"Cache miss for {kind} request {cache_key[:12]} in cache_only mode")
+        return cache_key, {"error": f"Cache miss for {kind} request {cache_key}", "cache_miss": True}
+    return cache_key, cached_response
+
+
 def create_image(
         prompt,
         model="dall-e-3",
@@ -110,20 +307,79 @@ def create_image(
         "user": user_id
     }
 
+    cache_key, cached_response = lookup_cache("image", payload)
+    if cached_response is not None:
+        return cached_response
+
     print("Request payload:")
     print(json.dumps(payload, indent=4))
 
     try:
-        response = requests.post(dalle_endpoint, headers=headers, json=payload, timeout=60)
+        response = post_with_quota(dalle_endpoint, headers, payload, images=n)
         response.raise_for_status()
 
-        print("Response payload:")
-        print(json.dumps(response.json(), indent=4))
+        response_json = response.json()
 
-        return response.json()
+        print("Response payload:")
+        if response_format == "b64_json":
+            # Multi-megabyte base64 payloads are not worth dumping to the console
+            print(summarize_image_response(response_json))
+        else:
+            print(json.dumps(response_json, indent=4))
+
+        if cache_key is not None:
+            return cache_image_response(cache_key, response_json)
+        return response_json
     except requests.exceptions.RequestException as e:
         print(f"An error occurred: {e}")
-        return {"error": str(e)}
+        return build_error_response(e)
+
+
+def read_chat_stream(response, on_delta=None):
+    """
+    Parse a streamed chat completion (server-sent events) as it arrives.
+
+    :param response: A requests response opened with stream=True.
+    :param on_delta: Optional callback called with every piece of content as soon as it is received.
+    :return: The assembled response in the same shape as a non-streamed chat completion.
+    """
+    response_json = None
+    contents = {}
+    finish_reasons = {}
+
+    for line in response.iter_lines(decode_unicode=True):
+        # Blank lines separate events, lines starting with ':' are keep-alive comments
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+
+        chunk = json.loads(data)
+        if response_json is None:
+            response_json = {key: chunk.get(key) for key in ("id", "created", "model", "system_fingerprint")}
+            response_json["object"] = "chat.completion"
+
+        for choice in chunk.get("choices", []):
+            index = choice.get("index", 0)
+            content = choice.get("delta", {}).get("content")
+            if content:
+                contents.setdefault(index, []).append(content)
+                if on_delta is not None:
+                    on_delta(content)
+            if choice.get("finish_reason"):
+                finish_reasons[index] = choice["finish_reason"]
+
+    response_json = response_json or {"object": "chat.completion"}
+    response_json["choices"] = [
+        {
+            "index": index,
+            "message": {"role": "assistant", "content": "".join(contents.get(index, []))},
+            "finish_reason": finish_reasons.get(index),
+        }
+        for index in sorted(set(contents) | set(finish_reasons))
+    ]
+    return response_json
 
 
 # Define the chat_completion function with all options
@@ -143,7 +399,8 @@ def chat_completion(
         user_id=CHAT_USER_ID,
         stream=CHAT_STREAM,
         logit_bias=CHAT_LOGIT_BIAS,
-        response_format=CHAT_RESPONSE_FORMAT):
+        response_format=CHAT_RESPONSE_FORMAT,
+        on_delta=None):
 
     headers = {
         "Authorization": f"Bearer {openai_api_key}",
@@ -174,18 +431,32 @@ def chat_completion(
     if response_format is not None:
         payload["response_format"] = response_format
 
+    cache_key, cached_response = lookup_cache("chat", payload)
+    if cached_response is not None:
+        if stream and on_delta is not None and "choices" in cached_response:
+            # Replay the stored content so a streaming caller sees the same deltas as on a live request
+            for choice in cached_response["choices"]:
+                on_delta(choice["message"]["content"])
+        return cached_response
+
     print("Chat request payload:")
     print(json.dumps(payload, indent=4))
 
     try:
-        response = requests.post(chat_endpoint, headers=headers, json=payload, timeout=60)
+        response = post_with_quota(chat_endpoint, headers, payload, stream=stream)
         response.raise_for_status()
+        if stream:
+            response_json = read_chat_stream(response, on_delta)
+        else:
+            response_json = response.json()
         print("Chat response payload:")
-        print(json.dumps(response.json(), indent=4))
-        return response.json()
+        print(json.dumps(response_json, indent=4))
+        if cache_key is not None:
+            write_cache(cache_key, response_json)
+        return response_json
     except requests.exceptions.RequestException as e:
         print(f"An error occurred: {e}")
-        return {"error": str(e)}
+        return build_error_response(e)
 
      
 